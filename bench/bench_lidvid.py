@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from gen_pds4 import make_label
+
+## Command
+## python bench_lidvid.py [number of labels] [fields per label]
+##
+## Writes a collection of large observational labels, where the File_Area
+## table definitions make up most of the bytes, and times mkinv harvesting it
+## with the quick LIDVID scan and with the XML parser (-x). Defaults are 2000
+## labels of 400 fields each.
+
+args = sys.argv
+mkinv = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mkinv', 'mkinv.py'))
+
+label_count = int(args[1]) if len(args) > 1 else 2000
+field_count = int(args[2]) if len(args) > 2 else 400
+
+#methods
+
+def run(collection, extra):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, mkinv, collection, '-l', 'urn:nasa:pds:bench:data'] + extra, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+tmp = tempfile.mkdtemp(prefix='bench_lidvid_')
+try:
+    for n in range(label_count):
+        subdir = os.path.join(tmp, 'data', str(n // 1000))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, 'product_%s.xml' % n), 'w') as f:
+            q = f.write(make_label('urn:nasa:pds:bench:data:product_%s' % n, '1.0', field_count))
+
+    label_bytes = os.path.getsize(os.path.join(tmp, 'data', '0', 'product_0.xml'))
+    print('%s labels of %s bytes each' % (label_count, label_bytes))
+
+    #warm the page cache so both runs read from memory
+    run(tmp, [])
+    for name, extra in [('quick scan', []), ('xml parser', ['-x'])]:
+        elapsed = run(tmp, extra)
+        print('%-12s %8.2f s %10.0f labels/sec' % (name, elapsed, label_count/elapsed))
+finally:
+    shutil.rmtree(tmp)
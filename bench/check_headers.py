@@ -0,0 +1,100 @@
+import os
+import sys
+import tempfile
+import shutil
+
+from gen_fits import make_fits_set, card, header, data
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.normpath(os.path.join(here, '..', 'kwex')))
+import kwex
+from astropy.io import fits
+
+## Command
+## python check_headers.py [-n files]
+##
+## Checks that the FITS headers kwex reads straight from the header cards match
+## what astropy reads, on synthetic multi-extension files from gen_fits.py plus
+## one with COMMENT and HISTORY cards, and that kwex gives the same keywords with
+## and without -a. Needs astropy. Exits with status 1 if anything differs.
+##
+## -n <files>    Number of FITS files from gen_fits.py. Default is 5.
+
+COMMENTARY = ['COMMENT', 'HISTORY', '']
+
+#methods
+
+def commentary(kw, text):
+    return ('%-8s%s' % (kw, text)).ljust(80)
+
+def make_commentary_fits(fits_file):
+    '''writes a FITS file with commentary cards in the primary header and the extension'''
+    cards = [card('SIMPLE', True), card('BITPIX', 8), card('NAXIS', 0), card('EXTEND', True), card('OBJECT', 'TARGET'),
+             commentary('COMMENT', 'primary comment'), commentary('HISTORY', 'primary history')]
+    with open(fits_file, 'wb') as f:
+        q = f.write(header(cards))
+        cards = [card('XTENSION', 'IMAGE'), card('BITPIX', 16), card('NAXIS', 2), card('NAXIS1', 10), card('NAXIS2', 10),
+                 card('PCOUNT', 0), card('GCOUNT', 1), card('EXTNAME', 'SCI'), commentary('COMMENT', 'ext comment'),
+                 commentary('HISTORY', 'ext history')]
+        q = f.write(header(cards))
+        q = f.write(data(10, 2))
+
+def compare_headers(fits_file):
+    '''returns a list of differences between kwex's headers and astropy's for every HDU in fits_file'''
+    problems = []
+    with fits.open(fits_file) as f:
+        expected = [hdu.header for hdu in f]
+    headers = kwex.read_headers(fits_file, list(range(len(expected))))
+    if headers is None:
+        return ['%s: kwex could not read the headers' % fits_file]
+
+    for n, astropy_header in enumerate(expected):
+        #commentary cards have no value, so kwex leaves them out and switches to astropy when they're asked for
+        keywords = [kw for kw in dict.fromkeys(astropy_header) if kw not in COMMENTARY]
+        if not list(headers[n]) == keywords:
+            problems.append('%s HDU %s: keywords %s, astropy %s' % (fits_file, n, list(headers[n]), keywords))
+        for kw in keywords:
+            value = headers[n].get(kw)
+            if not (value == astropy_header[kw] and type(value) == type(astropy_header[kw])):
+                problems.append('%s HDU %s: %s = %r, astropy %r' % (fits_file, n, kw, value, astropy_header[kw]))
+    return problems
+
+def compare_keywords(fits_file, kw_file):
+    '''returns a list of differences between kwex's keywords for fits_file with and without -a'''
+    plan = kwex.get_plan(kw_file)
+    native = kwex.extract_keywords(fits_file, plan)
+    astropy = kwex.extract_keywords(fits_file, plan, use_astropy=True)
+    return ['%s: %s, with -a %s' % (fits_file, a, b) for a, b in zip(native, astropy) if not a == b]
+
+args = sys.argv
+files = int(args[args.index('-n')+1]) if '-n' in args else 5
+
+tmp = tempfile.mkdtemp(prefix='check_')
+try:
+    kw_file = make_fits_set(tmp, files, objects=2)
+    data_dir = os.path.join(tmp, 'data')
+    problems = []
+    for name in sorted(os.listdir(data_dir)):
+        if name.endswith('.fits'):
+            problems += compare_headers(os.path.join(data_dir, name))
+            problems += compare_keywords(os.path.join(data_dir, name), kw_file)
+
+    fits_file = os.path.join(tmp, 'commentary.fits')
+    make_commentary_fits(fits_file)
+    problems += compare_headers(fits_file)
+    comment_kw_file = os.path.join(tmp, 'commentary.csv')
+    with open(comment_kw_file, 'w') as f:
+        #only extension commentary, so nothing else in the keyword file sends it to astropy
+        q = f.write('OBJECT,FITS\nEXTNAME_EXT1,FITS\nCOMMENT_EXT1,FITS\nHISTORY_EXT1,FITS\n')
+    problems += compare_keywords(fits_file, comment_kw_file)
+    found = dict(kwex.extract_keywords(fits_file, comment_kw_file))
+    if not 'ext comment' in found.get('COMMENT_EXT1', ''):
+        problems.append('%s: COMMENT_EXT1 = %s' % (fits_file, found.get('COMMENT_EXT1')))
+finally:
+    shutil.rmtree(tmp)
+
+for problem in problems:
+    print(problem)
+print('%s FITS files checked, %s differences' % (files + 1, len(problems)))
+if problems:
+    sys.exit(1)
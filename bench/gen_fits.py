@@ -0,0 +1,124 @@
+import os
+import sys
+
+## Command
+## python gen_fits.py <output directory> [-n files] [-e extensions] [-k keywords]
+##                    [-l loop length] [-s image size] [-o objects]
+##
+## Writes synthetic multi-extension FITS files, each with a PDS3 label, and a
+## keyword file that reads from all of them, for benchmarking kwex. The FITS
+## files are written card by card, so this needs neither astropy nor numpy.
+##
+## -n <files>         Number of FITS files. Default is 100.
+## -e <extensions>    Image extensions after the primary HDU. Default is 3.
+## -k <keywords>      Plain KEYnnn keywords in every header. Default is 50.
+## -l <loop length>   How many times each indexed keyword (FILTERn, WAVEn in the
+##                    primary header, AMPn, GAINn in the extensions) repeats.
+##                    Default is 20.
+## -s <image size>    Width and height in pixels of each image, whose data kwex
+##                    should skip over without reading. Default is 256.
+## -o <objects>       IMAGE objects in each PDS3 label, each with a SUBFRAME
+##                    object nested inside. Default is 10.
+##
+## The keyword file is written as keywords.csv in the output directory, and the
+## FITS files and labels in a data directory inside it.
+
+BLOCK = 2880
+CARD = 80
+
+#methods
+
+def card(kw, value):
+    '''returns an 80 character header card in the fixed format'''
+    if isinstance(value, bool):
+        line = '%-8s= %20s' % (kw, 'T' if value else 'F')
+    elif isinstance(value, (int, float)):
+        line = '%-8s= %20s' % (kw, value)
+    else:
+        line = "%-8s= '%-8s'" % (kw, value.replace("'", "''"))
+    return line.ljust(CARD)
+
+def header(cards):
+    '''returns a header unit of cards, padded out to whole blocks'''
+    text = ''.join(cards) + 'END'.ljust(CARD)
+    return (text + ' ' * (-len(text) % BLOCK)).encode('ascii')
+
+def data(size, bytes_per_pixel):
+    '''returns an all-zero data unit for a size x size image'''
+    length = size * size * bytes_per_pixel
+    return bytes(length + (-length % BLOCK))
+
+def plain_cards(keywords, n):
+    return [card('KEY%03d' % k, k * 1.5 + n) for k in range(1, keywords+1)]
+
+def make_fits(fits_file, n, extensions=3, keywords=50, loop=20, size=256):
+    cards = [card('SIMPLE', True), card('BITPIX', 16), card('NAXIS', 2), card('NAXIS1', size), card('NAXIS2', size),
+             card('EXTEND', True), card('OBJECT', 'TARGET%s' % n), card('EXPTIME', 1.5 + n), card('DATE-OBS', '2020-01-01T00:00:%02d' % (n % 60))]
+    cards += plain_cards(keywords, n)
+    for i in range(1, loop+1):
+        cards += [card('FILTER%s' % i, 'F%s' % i), card('WAVE%02d' % i, 400.0 + i)]
+
+    with open(fits_file, 'wb') as f:
+        q = f.write(header(cards))
+        q = f.write(data(size, 2))
+        for e in range(1, extensions+1):
+            cards = [card('XTENSION', 'IMAGE'), card('BITPIX', -32), card('NAXIS', 2), card('NAXIS1', size), card('NAXIS2', size),
+                     card('PCOUNT', 0), card('GCOUNT', 1), card('EXTNAME', 'SCI%s' % e)]
+            cards += plain_cards(keywords, n)
+            for i in range(1, loop+1):
+                cards += [card('AMP%s' % i, 'A%s' % i), card('GAIN%s' % i, 2.0 + i / 10)]
+            q = f.write(header(cards))
+            q = f.write(data(size, 4))
+
+def make_pds3(pds3_file, n, objects=10):
+    lines = ['PDS_VERSION_ID = PDS3', '/* NOTE: EXPOSURE_ID = EXP%s */' % n, 'RECORD_TYPE = FIXED_LENGTH',
+             'TARGET_NAME = "TARGET %s"' % n, 'DESCRIPTION = "a synthetic product, with a description', '  wrapped over two lines"']
+    for o in range(objects):
+        lines += ['OBJECT = IMAGE', '  LINES = %s' % (o+1), '  LINE_SAMPLES = %s' % (o+2),
+                  '  OBJECT = SUBFRAME', '    FIRST_LINE = %s' % o, '  END_OBJECT = SUBFRAME', 'END_OBJECT = IMAGE']
+    lines += ['OBJECT = TABLE', '  ROWS = 5']
+    for c in range(objects):
+        lines += ['  OBJECT = COLUMN', '    NAME = C%s' % c, '  END_OBJECT = COLUMN']
+    lines += ['END_OBJECT = TABLE', 'NOTE = "SOURCE_ID = S%s and' % n, '  more notes"', 'END']
+    with open(pds3_file, 'w') as f:
+        q = f.write('\n'.join(lines) + '\n')
+
+def make_keywords(kw_file, extensions=3, keywords=50, objects=10):
+    '''writes a keyword file using every kind of keyword kwex reads: primary and extension, looped, nested PDS3, and comment'''
+    rows = ['OBJECT,FITS', 'EXPTIME,FITS', 'DATE-OBS,FITS', 'FILTER.LOOP,FITS', 'WAVE.LOOP,FITS']
+    rows += ['KEY%03d,FITS' % k for k in range(1, keywords+1, 5)]
+    for e in range(1, extensions+1):
+        rows += ['EXTNAME_EXT%s,FITS' % e, 'KEY001_EXT%s,FITS' % e, 'AMP.LOOP_EXT%s,FITS' % e, 'GAIN.LOOP_EXT%s,FITS' % e]
+    rows += ['TARGET_NAME,PDS3', 'DESCRIPTION,PDS3', 'TABLE_0_ROWS,PDS3']
+    for o in range(objects):
+        rows += ['IMAGE_%s_LINES,PDS3' % o, 'IMAGE_%s_SUBFRAME_%s_FIRST_LINE,PDS3' % (o, o), 'TABLE_0_COLUMN_%s_NAME,PDS3' % o]
+    rows += ['EXPOSURE_ID,COMMENT', 'SOURCE_ID,COMMENT']
+    with open(kw_file, 'w') as f:
+        q = f.write('\n'.join(rows) + '\n')
+
+def make_fits_set(root, files=100, extensions=3, keywords=50, loop=20, size=256, objects=10):
+    '''writes files FITS files and their PDS3 labels to root/data, and returns the path of the keyword file for them'''
+    data_dir = os.path.join(root, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    for n in range(files):
+        make_fits(os.path.join(data_dir, 'img_%05d.fits' % n), n, extensions, keywords, loop, size)
+        make_pds3(os.path.join(data_dir, 'img_%05d.lbl' % n), n, objects)
+
+    kw_file = os.path.join(root, 'keywords.csv')
+    make_keywords(kw_file, extensions, keywords, objects)
+    return kw_file
+
+if __name__ == '__main__':
+    args = sys.argv
+
+    def get_arg(param, default):
+        return int(args[args.index(param)+1]) if param in args else default
+
+    if len(args) < 2 or args[1].startswith('-'):
+        print('No output directory specified.')
+        sys.exit()
+
+    files = get_arg('-n', 100)
+    kw_file = make_fits_set(args[1], files, get_arg('-e', 3), get_arg('-k', 50), get_arg('-l', 20), get_arg('-s', 256), get_arg('-o', 10))
+    print('%s FITS files and labels written to %s' % (files, os.path.join(args[1], 'data')))
+    print('keyword file: %s' % kw_file)
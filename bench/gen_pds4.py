@@ -0,0 +1,130 @@
+import os
+import sys
+
+## Command
+## python gen_pds4.py <output directory> [-n labels] [-d depth] [-b branching]
+##                    [-s fields per label] [-u duplicates] [-y secondary]
+##
+## Writes a synthetic PDS4 collection for benchmarking mkinv: a collection.xml
+## and observational labels spread over a directory tree.
+##
+## -n <labels>        Number of product labels. Default is 1000.
+## -d <depth>         Levels of subdirectories the labels are spread over.
+##                    Default is 2.
+## -b <branching>     Subdirectories in each directory. Default is 10.
+## -s <fields>        Field_Character entries in each label, which are most of a
+##                    label's size. A label is about 1.2 KB plus about 420 bytes
+##                    per field. Default is 10.
+## -u <duplicates>    Extra labels that repeat the LIDVID of another label, for
+##                    mkinv's integrity check to find. Default is 0.
+## -y <secondary>     Labels whose LID isn't under the collection LID, so they
+##                    show up as secondary members. Default is 0.
+
+COLLECTION_LID = 'urn:nasa:pds:bench:data'
+SECONDARY_LID = 'urn:nasa:pds:bench_other:data'
+
+#methods
+
+def make_label(lid, vid, fields):
+    field_list = ''.join(['''                <Field_Character>
+                    <name>FIELD_%s</name>
+                    <field_number>%s</field_number>
+                    <field_location unit="byte">%s</field_location>
+                    <data_type>ASCII_Real</data_type>
+                    <field_length unit="byte">12</field_length>
+                    <description>Synthetic field %s</description>
+                </Field_Character>
+''' % (n, n+1, n*12+1, n) for n in range(fields)])
+
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<?xml-model href="https://pds.nasa.gov/pds4/pds/v1/PDS4_PDS_1F00.sch" schematypens="http://purl.oclc.org/dsdl/schematron"?>
+<Product_Observational xmlns="http://pds.nasa.gov/pds4/pds/v1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+    <Identification_Area>
+        <logical_identifier>%s</logical_identifier>
+        <version_id>%s</version_id>
+        <title>Synthetic observational product</title>
+        <information_model_version>1.15.0.0</information_model_version>
+        <product_class>Product_Observational</product_class>
+    </Identification_Area>
+    <File_Area_Observational>
+        <File>
+            <file_name>product.tab</file_name>
+        </File>
+        <Table_Character>
+            <offset unit="byte">0</offset>
+            <records>1000</records>
+            <record_delimiter>Carriage-Return Line-Feed</record_delimiter>
+            <Record_Character>
+                <fields>%s</fields>
+                <groups>0</groups>
+                <record_length unit="byte">%s</record_length>
+%s            </Record_Character>
+        </Table_Character>
+    </File_Area_Observational>
+</Product_Observational>
+''' % (lid, vid, fields, fields*12+2, field_list)
+
+def make_collection_label(lid):
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<Product_Collection xmlns="http://pds.nasa.gov/pds4/pds/v1">
+    <Identification_Area>
+        <logical_identifier>%s</logical_identifier>
+        <version_id>1.0</version_id>
+        <title>Synthetic collection</title>
+        <information_model_version>1.15.0.0</information_model_version>
+        <product_class>Product_Collection</product_class>
+    </Identification_Area>
+    <File_Area_Inventory>
+        <File>
+            <file_name>inventory.csv</file_name>
+        </File>
+    </File_Area_Inventory>
+</Product_Collection>
+''' % lid
+
+def label_dir(root, n, total, depth, branching):
+    '''returns the directory for the nth of total labels spread evenly over branching**depth leaf directories'''
+    leaf = n * branching**depth // total
+    parts = []
+    for level in range(depth):
+        parts.insert(0, str(leaf % branching))
+        leaf //= branching
+    return os.path.join(root, *parts)
+
+def make_collection(root, labels=1000, depth=2, branching=10, fields=10, duplicates=0, secondary=0, lid=COLLECTION_LID):
+    '''writes a synthetic collection under root and returns the number of label files written, collection.xml aside.
+    the secondary labels are the last ones, and each duplicate repeats the LIDVID of one of the first labels.'''
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'collection.xml'), 'w') as f:
+        q = f.write(make_collection_label(lid))
+
+    made = set()
+    for n in range(labels + duplicates):
+        if n < labels:
+            product_lid = '%s:product_%s' % (SECONDARY_LID if n >= labels - secondary else lid, n)
+            name = 'product_%s.xml' % n
+        else:
+            #duplicates land in other directories than the labels they copy
+            product_lid = '%s:product_%s' % (lid, (n - labels) % labels)
+            name = 'duplicate_%s.xml' % (n - labels)
+
+        directory = label_dir(root, n, labels + duplicates, depth, branching)
+        if directory not in made:
+            os.makedirs(directory, exist_ok=True)
+            made.add(directory)
+        with open(os.path.join(directory, name), 'w') as f:
+            q = f.write(make_label(product_lid, '1.0', fields))
+    return labels + duplicates
+
+if __name__ == '__main__':
+    args = sys.argv
+
+    def get_arg(param, default):
+        return int(args[args.index(param)+1]) if param in args else default
+
+    if len(args) < 2 or args[1].startswith('-'):
+        print('No output directory specified.')
+        sys.exit()
+
+    written = make_collection(args[1], get_arg('-n', 1000), get_arg('-d', 2), get_arg('-b', 10), get_arg('-s', 10), get_arg('-u', 0), get_arg('-y', 0))
+    print('%s labels written to %s' % (written, args[1]))
@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from gen_pds4 import make_collection
+from gen_fits import make_fits_set
+
+## Command
+## python run_bench.py [-n labels] [-f fits files] [-j workers] [-r repeats]
+##                     [-s mkinv/kwex] [-o results file] [-b baseline file]
+##                     [-t percent] [-k]
+##
+## Generates a synthetic PDS4 collection and a set of FITS files with PDS3
+## labels in a temporary directory, then times mkinv and kwex over them in their
+## main modes, printing the throughput (labels/sec or files/sec) and peak memory
+## of each run. Everything is generated locally, so no network is needed. Peak
+## memory comes from wait4, so this runs on Linux (or other Unix) only, and is
+## for the tool's own process, not its -j worker processes. Each run includes
+## starting Python and importing the tool, so use enough files that this is
+## small next to the run itself.
+##
+## -n <labels>          Labels in the collection. Default is 5000.
+## -f <fits files>      FITS files, each with a PDS3 label. Default is 200.
+## -j <workers>         Workers for the -j runs. Default is 4.
+## -r <repeats>         Times each run is repeated, keeping the fastest. Default
+##                      is 3.
+## -s <mkinv/kwex>      Only runs the benchmarks for one tool.
+## -o <results file>    Writes the results to a JSON file.
+## -b <baseline file>   Compares the results to a results file from an earlier
+##                      run, and exits with status 1 if any run got slower.
+## -t <percent>         How much slower than the baseline a run can get before
+##                      it counts. Default is 10.
+## -k                   Keeps the generated files, and prints where they are.
+
+args = sys.argv
+here = os.path.dirname(os.path.abspath(__file__))
+mkinv = os.path.normpath(os.path.join(here, '..', 'mkinv', 'mkinv.py'))
+kwex = os.path.normpath(os.path.join(here, '..', 'kwex', 'kwex.py'))
+
+#methods
+
+def get_arg(param, default):
+    return args[args.index(param)+1] if param in args else default
+
+def measure(cmd, setup=None):
+    '''runs cmd and returns (wall seconds, peak resident memory in MB)'''
+    if setup is not None:
+        setup()
+    with tempfile.TemporaryFile() as err_file:
+        start = time.perf_counter()
+        p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=err_file)
+        #wait4 gives the resource usage of just this run
+        _, status, usage = os.wait4(p.pid, 0)
+        elapsed = time.perf_counter() - start
+        p.returncode = os.waitstatus_to_exitcode(status)
+        err_file.seek(0)
+        err = err_file.read().decode(errors='replace')
+    if p.returncode or 'Traceback' in err:
+        print('failed: %s' % ' '.join(cmd))
+        print(err)
+        sys.exit(1)
+    #ru_maxrss is in KB on Linux
+    return elapsed, usage.ru_maxrss / 1024
+
+def bench(name, cmd, count, unit, setup=None):
+    '''times cmd repeats times, and prints and returns the fastest run with the peak memory of any of them'''
+    timings = [measure(cmd, setup) for r in range(repeats)]
+    elapsed = min([t for t, mem in timings])
+    peak = max([mem for t, mem in timings])
+    result = {'seconds': elapsed, 'rate': count / elapsed, 'unit': unit, 'peak_mb': peak}
+    print('%-24s %8.2f s %10.0f %-10s %8.1f MB' % (name, elapsed, result['rate'], unit, peak))
+    runs[name] = result
+    return result
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+def compare(results, baseline, threshold):
+    '''prints each run's rate against the baseline and returns the names of those that got slower than threshold percent'''
+    if not baseline.get('params') == results['params']:
+        print('baseline was run with different parameters: %s' % baseline.get('params'))
+    slower = []
+    print()
+    for name, result in results['runs'].items():
+        if name not in baseline.get('runs', {}):
+            continue
+        ratio = result['rate'] / baseline['runs'][name]['rate']
+        flag = ''
+        if ratio < 1 - threshold/100:
+            flag = 'SLOWER'
+            slower.append(name)
+        print('%-24s %7.2fx baseline %s' % (name, ratio, flag))
+    return slower
+
+label_count = int(get_arg('-n', 5000))
+fits_count = int(get_arg('-f', 200))
+workers = get_arg('-j', '4')
+repeats = int(get_arg('-r', 3))
+suite = get_arg('-s', None)
+runs = {}
+
+tmp = tempfile.mkdtemp(prefix='bench_')
+try:
+    if suite in [None, 'mkinv']:
+        collection = os.path.join(tmp, 'collection')
+        #a few percent of the labels are duplicates and secondary members, so the integrity check has something to do
+        labels = make_collection(collection, label_count, depth=3, branching=6, fields=20, duplicates=label_count//50, secondary=label_count//50)
+        inventory = os.path.join(collection, 'inventory.csv')
+        cache = os.path.join(tmp, 'mkinv_cache.db')
+        print('mkinv: %s labels' % labels)
+
+        base = [sys.executable, mkinv, collection]
+        #warm the page cache so every run reads from memory
+        measure(base)
+        bench('mkinv', base, labels, 'labels/s')
+        bench('mkinv -x', base + ['-x'], labels, 'labels/s')
+        bench('mkinv -j %s' % workers, base + ['-j', workers], labels, 'labels/s')
+        bench('mkinv -i', base + ['-i'], labels, 'labels/s')
+        bench('mkinv -i -m 1', base + ['-i', '-m', '1'], labels, 'labels/s')
+        bench('mkinv -c (cold)', base + ['-c', cache], labels, 'labels/s', setup=lambda: remove(cache))
+        bench('mkinv -c (warm)', base + ['-c', cache], labels, 'labels/s')
+        remove(inventory)
+        print()
+
+    if suite in [None, 'kwex']:
+        fits_dir = os.path.join(tmp, 'fits')
+        kw_file = make_fits_set(fits_dir, fits_count)
+        data_dir = os.path.join(fits_dir, 'data')
+        out_dir = os.path.join(tmp, 'kwl')
+        store = os.path.join(tmp, 'store.jsonl')
+        cache = os.path.join(tmp, 'kwex_cache')
+        print('kwex: %s FITS files' % fits_count)
+
+        base = [sys.executable, kwex, '-b', data_dir, '-k', kw_file, '-o', out_dir]
+        measure(base)
+        bench('kwex -b', base, fits_count, 'files/s')
+        bench('kwex -b -j %s' % workers, base + ['-j', workers], fits_count, 'files/s')
+        bench('kwex -b -a', base + ['-a'], fits_count, 'files/s')
+        bench('kwex -b -s', base + ['-s', store], fits_count, 'files/s', setup=lambda: remove(store))
+        bench('kwex -b -c (cold)', base + ['-c', cache], fits_count, 'files/s', setup=lambda: remove(cache))
+        bench('kwex -b -c (warm)', base + ['-c', cache], fits_count, 'files/s')
+finally:
+    if '-k' in args:
+        print('generated files kept in %s' % tmp)
+    else:
+        shutil.rmtree(tmp)
+
+results = {'params': {'labels': label_count, 'fits': fits_count, 'workers': workers, 'repeats': repeats}, 'runs': runs}
+
+if '-o' in args:
+    with open(get_arg('-o', None), 'w') as f:
+        json.dump(results, f, indent=1)
+
+if '-b' in args:
+    with open(get_arg('-b', None)) as f:
+        slower = compare(results, json.load(f), float(get_arg('-t', 10)))
+    if slower:
+        print('%s runs slower than baseline' % len(slower))
+        sys.exit(1)
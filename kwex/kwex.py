@@ -1,12 +1,31 @@
-from astropy.io import fits
 import sys
 import re
 import csv
-from collections import defaultdict
+from collections import defaultdict, Counter
+from math import prod
 import os
+import glob
+import mmap
+import io
+import json
+import hashlib
+from contextlib import nullcontext
+import multiprocessing
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+#utils.py lives in the directory above this tool. it's loaded from there under a name nothing else uses instead of
+#putting that directory on sys.path, so it can't clash with a utils module of a program that imports this tool
+UTILS_NAME = '_pds_tools_utils'
+if UTILS_NAME not in sys.modules:
+    utils_spec = importlib.util.spec_from_file_location(UTILS_NAME, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils.py'))
+    sys.modules[UTILS_NAME] = importlib.util.module_from_spec(utils_spec)
+    utils_spec.loader.exec_module(sys.modules[UTILS_NAME])
+from _pds_tools_utils import scan, Log, Profile, DEBUG, INFO, ERROR
 
 ## Command
 ## python kwex -f <path to fits file> -k <path to csv file>
+## python kwex -b <directory, glob, or manifest> -k <path to csv file>
 ##
 ## Optional Parameters
 ## ===================
@@ -14,13 +33,68 @@ import os
 ## -l <path to lbl file>       Specifies a different name for the PDS3 label file.
 ##
 ## -o <path to output file>    Specifies a different name for the output file.
+##                             With -b, specifies a directory for the output
+##                             files instead.
 ##
-## -d                          Prints some minimal debugging to the console.
+## -b <directory/glob/list>    Batch mode. Extracts keywords from every FITS file
+##                             in a directory, matching a quoted glob pattern, or
+##                             listed one per line in a manifest file, loading
+##                             the keyword file only once.
+##
+## -e <fits extension>         With -b, finds FITS files in a directory with the
+##                             given extension. Default is .fits.
+##
+## -j <number of workers>      With -b, extracts from files across a pool of
+##                             worker processes. Default is 1.
+##
+## -a                          Reads FITS headers with astropy instead of reading
+##                             the header cards directly.
+##
+## -p                          Saves the compiled keyword file next to it as
+##                             <name>.plan.json, and reuses it on later runs for
+##                             as long as the keyword file doesn't change.
+##
+## -s <path to store file>     Appends each FITS file's keywords to a single
+##                             store file (one JSON record per line) instead of
+##                             writing a .kwl file per FITS file.
+##
+## -x <path to store file>     Writes .kwl files back out of a store file, next
+##                             to each original FITS file or in the -o directory.
+##
+## -n <filename,filename,...>  With -x, only writes .kwl files for these FILENAMEs.
+##
+## -c <cache directory>        Caches the keywords extracted from each FITS
+##                             file, keyed on the contents of the headers and
+##                             label they came from and the keyword file, and
+##                             reuses them when the same ones turn up again.
+##
+## -m <cache size in MB>       With -c, the most the cache directory may hold.
+##                             Least recently used entries are deleted after
+##                             each run to stay under it. Default is 100.
+##
+## -d <optional log file>      Prints some minimal debugging to the console, or
+##                             writes it to a log file instead, as JSON records
+##                             if it ends in .jsonl.
 ##							
+## --profile <optional report file> Prints how long each phase of the run took
+##                             and counts of the files, HDUs, and bytes it read,
+##                             or writes them to a file as JSON.
+##
+## --cprofile <dump file>      Runs the extraction under cProfile and dumps its
+##                             stats to a file.
+##
 ## -h, --help                  Print this file to the console.
 
 args = sys.argv
 
+#quiet, and with nothing cached, until main sets them up from the command line,
+#so the functions here can be imported and used on their own
+log = Log('kwex', quiet=True)
+profile = Profile('kwex')
+plan = None
+use_astropy = False
+cache_dir = None
+
 #methods
 
 def get_arg(param, else_name='', flag=False, req=False):
@@ -40,15 +114,22 @@ def get_arg(param, else_name='', flag=False, req=False):
         else:
             report('%s parameter not found' % param, out=req)
 
+def get_opt(param):
+    '''returns the full path given after a flag that can optionally take one, or None'''
+    if param in args and args.index(param)+1 < len(args) and not args[args.index(param)+1].startswith('-'):
+        return fix_path(args[args.index(param)+1])
+
 def report(msg, out=False):
-    if debug or out:
-        print(msg)
+    log(msg, ERROR if out else INFO)
 
     if out:
         print('kwex exited without finishing.')
         sys.exit()
 
-def add_to_out(kw, dic=None, file=None, value=None, kw_replace=None):
+class KwexError(Exception):
+    pass
+
+def add_to_out(output_list, kw, dic=None, file=None, value=None, kw_replace=None):
     if value is None:
         try:
             #actual line that gets the value of a keyword
@@ -76,166 +157,720 @@ def fix_path(path, exist=False):
     else:
         return return_path
 
-#if help command given, print readme and exit
-if get_arg('-h', flag=True) or get_arg('--help', flag=True):
-    with open('readme.txt') as f:
-        readme = f.read()
-        print()
-        print(readme)
-    sys.exit()
-
-#get command line arguments
-debug = get_arg('-d', flag=True)
-fits_file = fix_path(get_arg('-f', req=True), exist=True)
-kw_file = fix_path(get_arg('-k', req=True), exist=True)
-pds3_file = fix_path(get_arg('-l', '%s/%s.lbl' % (os.path.dirname(fits_file), os.path.splitext(os.path.basename(fits_file))[0])), exist = get_arg('-l', flag=True))
-out_file = fix_path(get_arg('-o', '%s/%s.kwl' % (os.path.dirname(fits_file), os.path.splitext(os.path.basename(fits_file))[0])))
-
-#get keyword list
-with open(kw_file, newline='') as f:
-    kw_reader = csv.reader(f, delimiter=',')
-    try:
-        kw_list = [(kw, kt) for (kw, kt) in kw_reader]
-    except ValueError:
-        report('invalid format in %s' % kw_file, out=True)
+#fits files are made of 2880 byte blocks, and headers of 80 byte cards
+BLOCK = 2880
+CARD = 80
+NUMBER_PATTERN = re.compile(r'[+-]?(\.\d+|\d+(\.\d*)?)([DEde][+-]?\d+)?$')
+STRING_PATTERN = re.compile(r"'((?:[^']|'')*)'\s*(/.*)?$")
+STRUCTURE_KEYWORDS = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT', 'GROUPS', 'ZIMAGE']
+
+class Header(dict):
+    '''header keywords and values, looked up case-insensitively like an astropy Header'''
+    def __missing__(self, key):
+        if isinstance(key, str) and not key == key.upper():
+            return self[key.upper()]
+        raise KeyError(key)
+
+def card_value(field):
+    '''returns the value in the value field of a header card as astropy would read it, or raises ValueError for anything it doesn't handle'''
+    field = field.strip()
+    if field.startswith("'"):
+        m = STRING_PATTERN.match(field)
+        if m is None:
+            raise ValueError(field)
+        #astropy ignores trailing spaces in strings
+        return m.group(1).replace("''", "'").rstrip()
+
+    value = field.split('/')[0].strip()
+    if value == 'T':
+        return True
+    elif value == 'F':
+        return False
+    elif NUMBER_PATTERN.match(value):
+        value = value.upper().replace('D', 'E')
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    else:
+        #undefined and complex values are left to astropy
+        raise ValueError(field)
 
-#reports invalid sources in csv file
-for n, k in enumerate(kw_list):
-    if k[1] not in ['PDS3', 'FITS', 'COMMENT']:
-        report('invalid source %s found on line %s of %s' % (k[1], n+1, kw_file))
+def header_blocks(fits_file, hdus):
+    '''returns {hdu number: header text} for each HDU in hdus, walking a memory-mapped fits_file from header to header
+    without touching any data units, or None if something in the file needs astropy to read it properly'''
+    with open(fits_file, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            #empty file
+            return None
+
+    blocks = {}
+    offset = 0
+    with mm:
+        for n in range(max(hdus)+1):
+            #only the keywords that say how big the data unit is are read here
+            header = Header()
+            start = offset
+            end = False
+            while not end:
+                if offset + BLOCK > len(mm):
+                    return None
+                try:
+                    block = mm[offset:offset+BLOCK].decode('ascii')
+                except UnicodeDecodeError:
+                    return None
+                if offset == start and not block[:8].rstrip() == ('XTENSION' if n else 'SIMPLE'):
+                    #not a fits file, or compressed, or something else astropy would have to make sense of
+                    return None
+                offset += BLOCK
+
+                for c in range(0, BLOCK, CARD):
+                    kw = block[c:c+8].rstrip()
+                    if kw == 'END':
+                        end = True
+                        break
+                    elif (kw in STRUCTURE_KEYWORDS or kw.startswith('NAXIS')) and block[c+8:c+10] == '= ' and kw not in header:
+                        try:
+                            header[kw] = card_value(block[c+10:c+CARD])
+                        except ValueError:
+                            return None
+
+            profile.count('HDUs read')
+            profile.count('bytes read', offset - start)
+            if n in hdus:
+                blocks[n] = mm[start:offset].decode('ascii')
 
-#creates a dictionary of each keyword source (FITS, PDS3, COMMENT)
-#and populates each dictionary with all the keywords that match that source
-kw_lists = {ktype:[rw for (rw, rt) in kw_list if rt == ktype] for ktype in set([kt for (kw, kt) in kw_list])}
+            try:
+                if header.get('ZIMAGE') is True:
+                    #astropy shows compressed images with their image header rather than the table header
+                    return None
+                dims = [header['NAXIS%s' % i] for i in range(1, header['NAXIS']+1)]
+                if n == 0 and header.get('GROUPS') is True and dims and dims[0] == 0:
+                    #random groups have no NAXIS1 axis
+                    dims = dims[1:]
+                size = 0
+                if dims:
+                    size = abs(header['BITPIX'])//8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + prod(dims))
+            except (KeyError, TypeError):
+                return None
+            #skip over the data unit without reading it
+            offset += -(-size // BLOCK) * BLOCK
+
+    return blocks
+
+def parse_header(text):
+    '''returns a Header of every keyword in the text of a header, or None if something in it needs astropy to read it properly'''
+    header = Header()
+    for c in range(0, len(text), CARD):
+        card = text[c:c+CARD]
+        kw = card[:8].rstrip()
+        if kw == 'END':
+            break
+        elif kw in ['CONTINUE', 'HIERARCH']:
+            #long strings and long keywords get left to astropy
+            return None
+        elif not card[8:10] == '= ' or kw in header:
+            #commentary cards have no value, and astropy gives the first card for repeated keywords
+            continue
+        try:
+            header[kw] = card_value(card[10:])
+        except ValueError:
+            return None
+    return header
+
+def read_headers(fits_file, hdus, blocks=None):
+    '''returns {hdu number: Header} for each HDU in hdus read straight from the header cards, or None if the file needs astropy.
+    blocks are the header blocks from header_blocks, if they've already been read'''
+    if blocks is None:
+        blocks = header_blocks(fits_file, hdus)
+    if blocks is None:
+        return None
+    headers = {n: parse_header(text) for n, text in blocks.items()}
+    if None in headers.values():
+        return None
+    return headers
+
+PDS3_OPEN = ['OBJECT', 'GROUP']
+PDS3_CLOSE = ['END_OBJECT', 'END_GROUP']
+
+def pds3_pairs(f):
+    '''yields [keyword, value] for each keyword in an open PDS3 label, with continuation lines joined onto their values'''
+    pair = None
+    for line in f:
+        #w is None if there's no equal sign. anything after a second equal sign is dropped
+        parts = line.split('=', 2)
+        k = parts[0].strip()
+        w = parts[1].strip() if len(parts) > 1 else None
+        if w is not None:
+            if pair is not None:
+                yield pair
+            pair = [k, w]
+        elif k in PDS3_CLOSE:
+            #END_OBJECT doesn't have to repeat the object name
+            if pair is not None:
+                yield pair
+            yield [k, None]
+            pair = None
+        elif not (k == 'END' or k == '') and pair is not None:
+            #when there's no kw=value pair, add the current line to the
+            #previous one if it's not empty or the end of the file
+            pair[1] = ' '.join([pair[1], k])
+    if pair is not None:
+        yield pair
+
+def match_comments(lines, comments, kcomm):
+    '''passes lines through, storing in kcomm the value at the end of the first line that contains each keyword in comments'''
+    remaining = list(dict.fromkeys(comments))
+    #one regex tells whether a line has any of the keywords still being looked for, so most lines are only checked once
+    pattern = re.compile('|'.join([re.escape(kw) for kw in remaining])) if remaining else None
+    for line in lines:
+        if pattern is not None and pattern.search(line):
+            for kw in remaining:
+                if kw in line:
+                    kcomm[kw] = line.split('=')[-1].strip()
+            remaining = [kw for kw in remaining if kw not in kcomm]
+            pattern = re.compile('|'.join([re.escape(kw) for kw in remaining])) if remaining else None
+        yield line
+
+def read_pds3(pds3_file, comments=[], keywords=True, label=None):
+    '''returns ({keyword: value}, {comment keyword: value}) from one pass over a PDS3 label. keywords inside objects and groups
+    are named OBJECT_N_KEYWORD, outermost object first, where N counts every instance of OBJECT in the label. keywords
+    inside groups also keep the name they'd have without their groups, which is how they've always been asked for.
+    label is the contents of the label, if it's already been read.'''
+    index = {}
+    kcomm = {}
+    counts = defaultdict(int)
+    #[name, OBJECT or GROUP] for each block the current line is inside
+    stack = []
+    #the label's bytes are decoded just as open would decode the file
+    with open(pds3_file) if label is None else io.TextIOWrapper(io.BytesIO(label)) as f:
+        lines = match_comments(f, comments, kcomm)
+        if not keywords:
+            #only comments are wanted, so stop reading once they've all been found
+            for line in lines:
+                if len(kcomm) == len(set(comments)):
+                    break
+            return index, kcomm
+
+        for k, w in pds3_pairs(lines):
+            if k in PDS3_OPEN:
+                stack.append(['%s_%s' % (w, counts[k, w]), k])
+                counts[k, w] += 1
+                index[k] = w
+            elif k in PDS3_CLOSE:
+                if stack:
+                    stack.pop()
+                if w is not None:
+                    index[k] = w
+            else:
+                #later keywords with the same name win
+                name = '_'.join([block for block, kind in stack] + [k])
+                bare = '_'.join([block for block, kind in stack if kind == 'OBJECT'] + [k])
+                if not bare == name:
+                    index[bare] = w
+                index[name] = w
+    return index, kcomm
+
+DIGITS = re.compile(r'\d')
+
+def loop_index(header):
+    '''returns {keyword with digits stripped: [keywords with digits, in header order]} for a header, so every .LOOP keyword is a lookup'''
+    index = defaultdict(list)
+    for kh in dict.fromkeys(header):
+        stem = DIGITS.sub('', kh)
+        if not stem == kh:
+            index[stem].append(kh)
+    return index
+
+#bump whenever the layout of a plan changes, so saved plans from older versions get recompiled
+PLAN_VERSION = 2
+SOURCES = ['PDS3', 'FITS', 'COMMENT']
+
+def compile_plan(kw_file):
+    '''compiles a keyword file into a plan of everything extract needs to know about it, so none of it is worked out again per FITS file'''
+    try:
+        with open(kw_file, 'rb') as f:
+            spec = f.read()
+    except OSError:
+        raise KwexError('could not read %s' % kw_file)
 
-report('loaded %s keywords from %s' % (len(kw_list), kw_file))
+    try:
+        kw_list = [(kw, kt) for (kw, kt) in csv.reader(io.StringIO(spec.decode(), newline=''), delimiter=',')]
+    except ValueError:
+        raise KwexError('invalid format in %s' % kw_file)
+
+    plan = {'version': PLAN_VERSION, 'spec': kw_file, 'spec_hash': hashlib.sha256(spec).hexdigest(), 'count': len(kw_list),
+            'warnings': [], 'PDS3': [], 'COMMENT': [], 'FITS': [], 'hdus': [0], 'astropy': False}
+
+    for n, (kw, kt) in enumerate(kw_list):
+        if kt not in SOURCES:
+            plan['warnings'].append('invalid source %s found on line %s of %s' % (kt, n+1, kw_file))
+        elif kt == 'FITS':
+            #works out which header each fits keyword comes from, so no other headers have to be read
+            if re.sub(r'\d', '', kw).endswith('_EXT'):
+                hdr = int(re.search(r'(?<=_EXT).+', kw).group(0))
+                k = re.search(r'.+?(?=_EXT)', kw).group(0)
+            else:
+                #if no explicit extension in keyword, assume primary header
+                hdr = 0
+                k = kw
+            if hdr not in plan['hdus']:
+                plan['hdus'].append(hdr)
+            if k in ['COMMENT', 'HISTORY', '']:
+                #commentary keywords only come out of astropy
+                plan['astropy'] = True
+
+            #each fits entry is [name in kwl, header number, keyword in header, whether it's a .LOOP keyword].
+            #.LOOP keywords from extension headers keep their _EXTN in the LOOP object
+            if k.endswith('.LOOP'):
+                plan['FITS'].append([kw.replace('.LOOP', ''), hdr, k.replace('.LOOP', ''), True])
+            else:
+                plan['FITS'].append([kw, hdr, k, False])
+        else:
+            plan[kt].append(kw)
 
-#reports duplicate keywords
-for kt in kw_lists:
-    for kw in set(kw_lists[kt]):
-        if kw_lists[kt].count(kw) > 1:
-            report('keyword %s found %s times' % (kw, kw_lists[kt].count(kw)))
+    #reports duplicate keywords
+    for kt in SOURCES:
+        for kw, count in Counter([kw for (kw, t) in kw_list if t == kt]).items():
+            if count > 1:
+                plan['warnings'].append('keyword %s found %s times' % (kw, count))
 
-output_list = []
+    return plan
 
-#no matter what, assign filename to a keyword
-add_to_out('FILENAME', value=os.path.splitext(os.path.basename(fits_file))[0])
+def get_plan(kw_file, save=False):
+    '''returns the plan for kw_file. with save, reuses the plan saved next to kw_file if the keyword file hasn't changed since, or saves a new one'''
+    plan_file = '%s.plan.json' % os.path.splitext(kw_file)[0]
+    if save and os.path.isfile(plan_file):
+        try:
+            with open(kw_file, 'rb') as f:
+                spec_hash = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            raise KwexError('could not read %s' % kw_file)
+        try:
+            with open(plan_file) as f:
+                plan = json.load(f)
+            if plan.get('version') == PLAN_VERSION and plan.get('spec_hash') == spec_hash:
+                report('plan loaded from %s' % plan_file)
+                plan['spec'] = kw_file
+                return plan
+        except (OSError, ValueError):
+            pass
+
+    plan = compile_plan(kw_file)
+    if save:
+        try:
+            with open(plan_file, 'w') as f:
+                json.dump(plan, f, indent=1)
+            report('plan saved to %s' % plan_file)
+        except OSError:
+            report('could not save plan to %s' % plan_file)
+    return plan
+
+def extract(fits_file, pds3_file, plan, use_astropy=False, blocks=None, label=None):
+    '''returns the kwl lines for the keywords in plan from fits_file and its PDS3 label. blocks and label are the
+    header blocks and label contents, if they've already been read'''
+    output_list = []
+
+    #no matter what, assign filename to a keyword
+    add_to_out(output_list, 'FILENAME', value=os.path.splitext(os.path.basename(fits_file))[0])
+
+    if (plan['PDS3'] or plan['COMMENT']) and not os.path.isfile(pds3_file):
+        source = 'keywords' if plan['PDS3'] else 'comments'
+        raise KwexError('PDS3 %s found in %s but PDS3 label %s not found.' % (source, plan['spec'], pds3_file))
+    elif plan['PDS3'] or plan['COMMENT']:
+        #get pds3 keywords and comments from a single read of the label
+        with profile.phase('pds3'):
+            pds3_index, kcomm = read_pds3(pds3_file, plan['COMMENT'], bool(plan['PDS3']), label)
+        profile.count('labels parsed')
+        if profile.enabled:
+            profile.count('bytes read', os.path.getsize(pds3_file))
+
+        #search for requested keywords in pds3 keyword dictionary and add to output list
+        for kw in plan['PDS3']:
+            add_to_out(output_list, kw, pds3_index, pds3_file)
+
+        #add requested comments in pds3 label to output list
+        for kw in plan['COMMENT']:
+            add_to_out(output_list, kw, kcomm, pds3_file)
+
+    #get fits headers
+    if plan['FITS']:
+        #only the headers the keyword file asks for get read
+        with profile.phase('fits'):
+            hdr_list = None if use_astropy or plan['astropy'] else read_headers(fits_file, plan['hdus'], blocks)
+            if hdr_list is None:
+                #astropy takes a while to import, so it's only loaded once a file needs it
+                from astropy.io import fits
+                profile.count('files read with astropy')
+                with fits.open(fits_file) as f:
+                    hdr_list = {n: f[n].header for n in plan['hdus']}
+
+        #search for requested keywords in fits keyword list and add to output list
+        kw_loop = {}
+        loop_indexes = {}
+        loop_count = 0
+
+        for kout, hdr, k, loop in plan['FITS']:
+            if not loop:
+                add_to_out(output_list, k, hdr_list[hdr], fits_file, kw_replace=kout)
+                continue
+
+            #iterative keywords
+            if hdr not in loop_indexes:
+                loop_indexes[hdr] = loop_index(hdr_list[hdr])
+            loop_match = loop_indexes[hdr].get(k, [])
+            if not loop_match:
+                #with nothing to loop over, the keyword itself is written under the name asked for, like any other keyword
+                if k in hdr_list[hdr]:
+                    add_to_out(output_list, kout, value=hdr_list[hdr][k])
+                else:
+                    add_to_out(output_list, kout, {}, fits_file)
+                continue
 
-#get pds3 keywords
-if 'PDS3' in kw_lists.keys() and os.path.isfile(pds3_file):
-    klist = []
-    with open(pds3_file) as f:
-        #split each line into tidy keyword:value pairs
-        for line in f:
-            #w is None if there's no equal sign or nothing on the other side of it
-            k, w = ([p.strip() for p in line.split('=')][:2] + [None]*2)[:2]
-            if w is not None:
-                klist.append([k, w])
-            elif not (k == 'END' or k == ''):
-                #when there's no kw=value pair, add the current line to the
-                #previous one if it's not empty or the end of the file
-                try:
-                    klist[-1][1] = ' '.join([klist[-1][1], k])
-                except:
-                    pass
-            
-    #identify each object in the label and which lines comprise that object
-    obj_dict = defaultdict(lambda: []) #dictionary of object types, where each type will have a list of each instance of that type
-    for n, line in enumerate(klist):
-        kw, value = line
-        if kw == 'OBJECT':
-            obj_dict[value].append([]) #every time a new object is found, adds an empty list for this instance of the object
-            obj_line_count = n+1
-            while obj_line_count < len(klist) and not klist[obj_line_count] == ['END_OBJECT', value]:
-                if klist[obj_line_count][0] not in ['OBJECT', 'END_OBJECT']:
-                    obj_dict[value][-1].append(obj_line_count) #adds the current line number to the list for this instance of the object type
-                obj_line_count += 1
-                
-    #add object names to keywords
-    for obj in obj_dict:
-        for n, line in enumerate(obj_dict[obj]):
-            for l in line:
-                klist[l][0] = '%s_%s.%s' % (obj, n, klist[l][0])
-
-    #reverse object names in keywords to get proper order
-    for k in klist:
-        ksplit = k[0].split('.')
-        if len(ksplit) > 1:
-            k[0] = '_'.join(list(reversed(ksplit[:-1]))) + '_' + ksplit[-1]
-
-    #search for requested keywords in pds3 keyword dictionary and add to output list
-    for kw in kw_lists['PDS3']:
-        add_to_out(kw, {k:v for (k, v) in klist}, pds3_file)
-elif 'PDS3' in kw_lists.keys() and not os.path.isfile(pds3_file):
-    report('PDS3 keywords found in %s but PDS3 label %s not found.' % (kw_file, pds3_file), out=True)
-
-#search for requested comments in pds3 label and add to output list
-if 'COMMENT' in kw_lists.keys() and os.path.isfile(pds3_file):
-    kcomm = {}
-    kw_found = defaultdict(lambda: False)
-    with open(pds3_file) as f:
+            loop_count = max([loop_count, len(loop_match)])
+            kw_loop[kout] = (hdr, loop_match)
+
+        #create output string of PDS3-like objects for any iterative keywords
+        for n in range(loop_count):
+            add_to_out(output_list, 'OBJECT', value='LOOP')
+            for kout, (hdr, loop_match) in kw_loop.items():
+                if n < len(loop_match):
+                    add_to_out(output_list, loop_match[n], hdr_list[hdr], fits_file, kw_replace='  %s' % kout)
+                else:
+                    #not found when there are fewer of this keyword than the longest loop
+                    add_to_out(output_list, kout, {}, fits_file, kw_replace='  %s' % kout)
+            add_to_out(output_list, 'END_OBJECT', value='LOOP')
+
+    if log.enabled(INFO):
+        report('%s keyword:value pairs plus filename extracted' % (len([k for k in output_list if not 'LOOP' in k])-1))
+    return output_list
+
+def write_kwl(out_file, output_list):
+    with open(out_file, 'w') as f:
+        q = f.write('\n'.join(output_list) + '\nEND\n')
+
+def default_path(fits_file, ext, out_dir=None):
+    #files that go with a FITS file share its name
+    return '%s/%s%s' % (out_dir or os.path.dirname(fits_file), os.path.splitext(os.path.basename(fits_file))[0], ext)
+
+def store_record(fits_file, output_list):
+    '''returns the line for a FITS file's keywords in a store file'''
+    #keywords never contain ' = ', so each kwl line splits back into its keyword and value
+    return json.dumps({'FILENAME': os.path.splitext(os.path.basename(fits_file))[0], 'FITS': fits_file,
+                       'KEYWORDS': [line.split(' = ', 1) for line in output_list]})
+
+def export_store(store_file, out_dir=None, names=None):
+    '''writes a kwl file for each FILENAME in store_file (or just those in names), using the last record for each, and returns the FILENAMEs written'''
+    offsets = {}
+    with open(store_file, 'rb') as f:
+        #first pass only notes where each record starts, so the store never has to fit in memory
+        offset = 0
         for line in f:
-            for kw in kw_lists['COMMENT']:
-                if kw in line and not kw_found[kw]:
-                    kcomm[kw] = line.split('=')[-1].strip()
-                    kw_found[kw] = True
-
-    for kw in kw_lists['COMMENT']:
-        add_to_out(kw, kcomm, pds3_file)
-elif 'COMMENT' in kw_lists.keys() and not os.path.isfile(pds3_file):
-    report('PDS3 comments found in %s but PDS3 label %s not found.' % (kw_file, pds3_file), out=True)
-
-#get fits headers
-if 'FITS' in kw_lists.keys():
-    with fits.open(fits_file) as f:
-        hdr_list = [h.header for h in f]
-
-    #search for requested keywords in fits keyword list and add to output list
-    kw_loop = defaultdict(lambda: list())
-    loop_count = 0
-
-    for kw in kw_lists['FITS']:
-        #check if kw is in extension header
-        knn = re.sub(r'\d', '', kw)
-        if knn.endswith('_EXT'):
-            hdr = int(re.search(r'(?<=_EXT).+', kw).group(0))
-            k = re.search(r'.+?(?=_EXT)', kw).group(0)
+            if line.strip():
+                name = json.loads(line)['FILENAME']
+                if names is None or name in names:
+                    offsets[name] = offset
+            offset += len(line)
+
+        for offset in offsets.values():
+            f.seek(offset)
+            record = json.loads(f.readline())
+            write_kwl(default_path(record['FITS'], '.kwl', out_dir), [' = '.join(pair) for pair in record['KEYWORDS']])
+    return list(offsets)
+
+#bump whenever extract's output changes for the same input, so older cached results stop matching
+CACHE_VERSION = 1
+
+def cache_key(fits_file, pds3_file, plan):
+    '''returns (a hash of everything extract reads from fits_file and its PDS3 label for plan, so the same headers, label,
+    and keyword file give the same key wherever the files live or whatever their dates, the header blocks hashed or None
+    if the file was hashed whole, the label contents hashed or None), so a miss doesn't have to read them again'''
+    key = hashlib.sha256(('%s\n%s\n%s\n' % (CACHE_VERSION, plan['spec_hash'], os.path.splitext(os.path.basename(fits_file))[0])).encode())
+    blocks = None
+    label = None
+    if (plan['PDS3'] or plan['COMMENT']) and os.path.isfile(pds3_file):
+        #a missing label is left for extract to report
+        with open(pds3_file, 'rb') as f:
+            label = f.read()
+        key.update(label)
+    if plan['FITS']:
+        #only the header blocks the keyword file asks for, never the data
+        blocks = None if plan['astropy'] else header_blocks(fits_file, plan['hdus'])
+        if blocks is None:
+            #files only astropy can read get hashed whole
+            with open(fits_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    key.update(chunk)
         else:
-            #if no explicit extension in keyword, assume primary header
-            hdr = 0
-            k = kw
-
-        #check for iterative keywords
-        if k.endswith('.LOOP'):
-            knl = k.replace('.LOOP', '')
-            #counts how many FITS keywords with numbers stripped match knl
-            loop_match = [[n.isnumeric() for n in kh].count(True) for kh in hdr_list[hdr] if re.sub(r'\d', '', kh) == knl]
-            if not loop_match:
-                add_to_out(knl, hdr_list[hdr], fits_file)
+            for n in plan['hdus']:
+                key.update(blocks[n].encode('ascii'))
+    return key.hexdigest(), blocks, label
 
-            loop_count = max([loop_count, len(loop_match)])
+def cache_get(key):
+    '''returns the cached kwl lines for key, or None if they aren't cached'''
+    path = os.path.join(cache_dir, key)
+    try:
+        with open(path) as f:
+            output_list = f.read().split('\n')
+    except OSError:
+        return None
+    #modified time marks when an entry was last used, for evict_cache
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return output_list
+
+def cache_put(key, output_list):
+    path = os.path.join(cache_dir, key)
+    #written under a temporary name first so other workers never read half an entry
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        q = f.write('\n'.join(output_list))
+    os.replace(tmp, path)
+
+def evict_cache(cache_dir, max_bytes):
+    '''deletes the least recently used entries in cache_dir until it fits in max_bytes, and returns how many were deleted'''
+    entries = []
+    for entry in scan(cache_dir):
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum([size for (_, size, _) in entries])
+
+    evicted = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    return evicted
+
+def cached_extract(fits_file, pds3_file, plan):
+    '''returns (the kwl lines from extract, whether they came from the cache or None with no cache)'''
+    if cache_dir is None:
+        with profile.phase('extract'):
+            return extract(fits_file, pds3_file, plan, use_astropy), None
+    with profile.phase('cache'):
+        key, blocks, label = cache_key(fits_file, pds3_file, plan)
+        output_list = cache_get(key)
+    if output_list is not None:
+        profile.count('cache hits')
+        return output_list, True
+    profile.count('cache misses')
+    with profile.phase('extract'):
+        #with no header blocks the file already turned out to need astropy
+        output_list = extract(fits_file, pds3_file, plan, use_astropy or (bool(plan['FITS']) and blocks is None), blocks, label)
+    with profile.phase('cache'):
+        cache_put(key, output_list)
+    return output_list, False
+
+def run_file(fits_file, pds3_file, out_file=None):
+    '''extracts keywords from one FITS file and writes its kwl, or returns its store record if out_file is None.
+    returns (store record, error message if it failed, whether it came from the cache or None with no cache)'''
+    hit = None
+    try:
+        output_list, hit = cached_extract(fits_file, pds3_file, plan)
+        with profile.phase('output'):
+            if out_file is None:
+                return store_record(fits_file, output_list), None, hit
+            write_kwl(out_file, output_list)
+        return None, None, hit
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e), hit
+
+def run_job(*job):
+    '''run_file in a worker, returning its result with the times and counts for --profile'''
+    return profile.remote(run_file, *job)
+
+def init_worker(worker_plan, worker_use_astropy, worker_cache_dir, debug, log_file):
+    global plan, use_astropy, cache_dir, log
+    plan, use_astropy, cache_dir = worker_plan, worker_use_astropy, worker_cache_dir
+    log = Log('kwex', debug, log_file, buffer_lines=1)
+
+def extract_keywords(fits_file, spec, pds3_file=None, use_astropy=False):
+    '''returns [(keyword, value)] from fits_file and its PDS3 label (pds3_file, or the .lbl file next to it) exactly as
+    they'd be written to its kwl file. spec is a keyword file, or a plan from get_plan, which saves compiling the keyword
+    file again for every FITS file. raises KwexError if the keyword file or a PDS3 label it needs can't be read.'''
+    plan = spec if isinstance(spec, dict) else get_plan(spec)
+    output_list = extract(fits_file, pds3_file or default_path(fits_file, '.lbl'), plan, use_astropy)
+    return [tuple(line.split(' = ', 1)) for line in output_list]
+
+def batch_list(source, ext):
+    '''returns the FITS files in a directory, matching a glob pattern, or listed in a manifest file'''
+    if os.path.isdir(source):
+        return [entry.path for entry in scan(source, ext)]
+    elif glob.has_magic(source):
+        return sorted([fix_path(p) for p in glob.glob(source, recursive=True) if os.path.isfile(p)])
+    elif os.path.isfile(source):
+        #manifest paths are relative to the manifest
+        with open(source) as f:
+            lines = [line.strip() for line in f]
+        return [os.path.normpath(os.path.join(os.path.dirname(source), line)) for line in lines if line and not line.startswith('#')]
+    else:
+        raise KwexError('%s not found.' % source)
+
+def run_batch(jobs, workers):
+    '''yields the result of run_file for each job, in order, as they finish'''
+    if workers < 2 or not jobs:
+        for job in jobs:
+            yield run_file(*job)
+        return
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        #forked workers inherit the loaded plan
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    else:
+        #spawned workers import this file without running main, so they're handed what main set up
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(plan, use_astropy, cache_dir, log.level == DEBUG, log.log_file))
+
+    with pool:
+        for result, stats in pool.map(run_job, *zip(*jobs), chunksize=max(1, min(64, len(jobs) // (workers*4)))):
+            profile.merge(stats)
+            yield result
+
+def main():
+    global log, profile, plan, use_astropy, cache_dir
+
+    #if help command given, print readme and exit
+    if get_arg('-h', flag=True) or get_arg('--help', flag=True):
+        with open('readme.txt') as f:
+            readme = f.read()
+            print()
+            print(readme)
+        sys.exit()
 
-            for count, digit in enumerate(loop_match):
-                #tracks original digits in kwNN indexing to pull from correctly
-                digit_string = '{:0%sd}' % digit
-                kw_loop[knl].append('%s%s' % (knl, digit_string.format(count)))
-        else:
-            add_to_out(k, hdr_list[hdr], fits_file, kw_replace=kw)
+    #get command line arguments
+    debug = get_arg('-d', flag=True)
+    log = Log('kwex', debug, get_opt('-d'))
+    profiling = get_arg('--profile', flag=True)
+    profile = Profile('kwex', profiling)
+    profile_file = get_opt('--profile')
+    cprofile_file = fix_path(get_arg('--cprofile')) if get_arg('--cprofile', flag=True) else None
+    use_astropy = get_arg('-a', flag=True)
+    workers = get_arg('-j', '1')
+    try:
+        workers = int(workers)
+    except ValueError:
+        report('invalid -j parameter', out=True)
+
+    #write kwl files back out of a store file, which needs no fits files or keyword list
+    if get_arg('-x', flag=True):
+        store_file = fix_path(get_arg('-x', req=True), exist=True)
+        out_dir = fix_path(get_arg('-o')) if get_arg('-o', flag=True) else None
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+        names = get_arg('-n').split(',') if get_arg('-n', flag=True) else None
+
+        exported = export_store(store_file, out_dir, names)
+        print('%s kwl files written from %s' % (len(exported), store_file))
+        for name in set(names or []) - set(exported):
+            print('%s not found in %s' % (name, store_file))
+        sys.exit()
 
-    #create output string of PDS3-like objects for any iterative keywords
-    for n in range(loop_count):
-        add_to_out('OBJECT', value='LOOP')
-        for knl in kw_loop:
-            #adds kw+nth as keyword value when kwNN doesn't work (because it wasn't found)
-            try:
-                kloop = kw_loop[knl][n]
-            except:
-                kloop = '%s%s' % (knl, n)
-
-            add_to_out(kloop, hdr_list[hdr], fits_file, kw_replace='  %s' % knl)
-        add_to_out('END_OBJECT', value='LOOP')
-        
-#output found keyword value pairs to kwl file
-report('%s keyword:value pairs plus filename extracted' % (len([k for k in output_list if not 'LOOP' in k])-1))
-with open(out_file, 'w') as f:
-    q = f.write('\n'.join(output_list) + '\nEND\n')
+    store_file = fix_path(get_arg('-s')) if get_arg('-s', flag=True) else None
+
+    #cache of extracted keywords, reused whenever the same headers and label are extracted with the same keyword file
+    cache_dir = fix_path(get_arg('-c')) if get_arg('-c', flag=True) else None
+    cache_size = get_arg('-m', '100')
+    try:
+        cache_size = float(cache_size) * 1024 * 1024
+    except ValueError:
+        report('invalid -m parameter', out=True)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    if not get_arg('-b', flag=True):
+        fits_file = fix_path(get_arg('-f', req=True), exist=True)
+        pds3_file = fix_path(get_arg('-l', default_path(fits_file, '.lbl')), exist = get_arg('-l', flag=True))
+        out_file = fix_path(get_arg('-o', default_path(fits_file, '.kwl')))
+    kw_file = fix_path(get_arg('-k', req=True), exist=True)
+
+    #compile keyword list into an extraction plan
+    try:
+        with profile.phase('plan'):
+            plan = get_plan(kw_file, save=get_arg('-p', flag=True))
+    except KwexError as e:
+        report(str(e), out=True)
+
+    report('loaded %s keywords from %s' % (plan['count'], kw_file))
+    for warning in plan['warnings']:
+        report(warning)
+
+    if get_arg('-b', flag=True):
+        try:
+            with profile.phase('list'):
+                fits_files = batch_list(fix_path(get_arg('-b', req=True)), get_arg('-e', '.fits'))
+        except KwexError as e:
+            report(str(e), out=True)
+        profile.count('files scanned', len(fits_files))
+        out_dir = fix_path(get_arg('-o')) if get_arg('-o', flag=True) else None
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+        if get_arg('-l', flag=True):
+            report('-l ignored in batch mode. Each PDS3 label must share its FITS file name.')
+
+        report('%s FITS files found' % len(fits_files))
+        #with a store file, workers hand their keywords back to be appended here rather than writing kwl files
+        jobs = [(fits_file, default_path(fits_file, '.lbl'), None if store_file else default_path(fits_file, '.kwl', out_dir)) for fits_file in fits_files]
+        failures = []
+        hits = Counter()
+        #whatever the batch does besides extracting, like waiting on workers, is charged to batch
+        with open(store_file, 'a') if store_file else nullcontext() as store, profile.cprofile(cprofile_file):
+            for (fits_file, _, _), (record, error, hit) in zip(jobs, profile.iterate('batch', run_batch(jobs, workers))):
+                hits[hit] += 1
+                if error is not None:
+                    failures.append((fits_file, error))
+                elif record is not None:
+                    with profile.phase('output'):
+                        q = store.write(record + '\n')
+
+        #summary of the whole batch is always printed, and failures are also written out so they can be rerun
+        print('%s of %s FITS files extracted' % (len(jobs)-len(failures), len(jobs)))
+        if cache_dir is not None:
+            print('cache: %s hits, %s misses' % (hits[True], hits[False]))
+        if failures:
+            failure_file = os.path.join(out_dir or os.getcwd(), 'kwex_failures.csv')
+            with open(failure_file, 'w', newline='') as f:
+                cw = csv.writer(f)
+                for fits_file, error in failures:
+                    print('failed: %s (%s)' % (fits_file, error))
+                    q = cw.writerow([fits_file, error])
+            print('failures written to %s' % failure_file)
+    else:
+        profile.count('files scanned')
+        try:
+            with profile.cprofile(cprofile_file):
+                output_list, hit = cached_extract(fits_file, pds3_file, plan)
+        except KwexError as e:
+            report(str(e), out=True)
+        if hit is not None:
+            report('cache %s' % ('hit' if hit else 'miss'))
+
+        #output found keyword value pairs to kwl file, or to the store file
+        with profile.phase('output'):
+            if store_file:
+                with open(store_file, 'a') as f:
+                    q = f.write(store_record(fits_file, output_list) + '\n')
+            else:
+                write_kwl(out_file, output_list)
+
+    if cache_dir is not None:
+        with profile.phase('cache'):
+            evicted = evict_cache(cache_dir, cache_size)
+        if evicted:
+            report('%s cache entries evicted' % evicted)
+
+    if profiling:
+        profile.report(profile_file)
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,28 @@ import csv
 import os
 import sys
 import re
+import sqlite3
+import heapq
+import tempfile
+import multiprocessing
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import groupby, islice
+from collections import defaultdict, deque, Counter
+from contextlib import ExitStack
+
+#utils.py lives in the directory above this tool. it's loaded from there under a name nothing else uses instead of
+#putting that directory on sys.path, so it can't clash with a utils module of a program that imports this tool
+UTILS_NAME = '_pds_tools_utils'
+if UTILS_NAME not in sys.modules:
+    utils_spec = importlib.util.spec_from_file_location(UTILS_NAME, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils.py'))
+    sys.modules[UTILS_NAME] = importlib.util.module_from_spec(utils_spec)
+    utils_spec.loader.exec_module(sys.modules[UTILS_NAME])
+from _pds_tools_utils import scan, Log, Profile, DEBUG, INFO, WARNING, ERROR
 
 ## Command
 ## python mkinv.py <path to collection>
+## python mkinv.py <path to bundle> -b
 ##
 ## Optional Parameters
 ## ===================
@@ -31,19 +50,62 @@ import re
 ## 
 ## -d <optional log file>  Include to print some basic debugging info to the
 ##                         console. If a file is included, writes the debugging to
-##                         a log file instead.
+##                         a log file instead, as JSON records if it ends in .jsonl.
+##
+## -j <number of workers>  Parses labels across a pool of worker processes.
+##                         Default is 1, which parses labels serially.
+##
+## -t                      Include with -j to use worker threads instead of
+##                         processes, which is usually faster on network mounts
+##                         where reading the labels is the slow part.
+##
+## -x                      Include to parse every label with the XML parser
+##                         instead of first scanning the top of each label for
+##                         its LID and VID.
+##
+## -c <optional cache file> Include to keep a cache of each label's size,
+##                         modification time, and LIDVID between runs, so only
+##                         new or changed labels get parsed. Default cache file
+##                         is .mkinv_cache.db in the collection directory.
+##
+## -m <memory budget in MB> Include with -i to sort and compare LIDVIDs in
+##                         bounded runs on disk instead of in memory, and to
+##                         write a diff report of added, already present,
+##                         version-bumped, and older LIDVIDs next to the
+##                         inventory file.
+##
+## -w <number of threads>  Lists directories with a pool of threads. Default is
+##                         1. Helps on network filesystems where each directory
+##                         listing is slow.
 ## 
+## --profile <optional report file> Include to print how long each phase of the
+##                         run took and counts of the files and bytes it read.
+##                         If a file is included, writes them to it as JSON.
+##
+## --cprofile <dump file>  Include to run the walk, harvest, and inventory
+##                         writing under cProfile and dump its stats to a file.
+##
+## -b                      Include to make an inventory for every collection in a
+##                         bundle from one walk of the bundle directory, and to
+##                         check for LIDVIDs found in more than one collection.
+##                         -f is then the file name used in each collection.
+##
 ## -h, --help              Print this file to the console.
 
 args = sys.argv
 
+NS = 'http://pds.nasa.gov/pds4/pds/v%s'
+#compared against when there's neither a collection file nor a -l LID
+DEFAULT_LID = 'urn:nasa:pds:bundle_id:collection_id'
+
+#quiet until main sets them up from the command line, so the functions here can be imported and used on their own
+log = Log('mkinv', quiet=True)
+profile = Profile('mkinv')
+
 #methods
 
-def file_list(path, ext='', excl=[]):
-    fl = []
-    for root, _, file in os.walk(path):
-        fl.extend([os.path.normpath(os.path.join(root, fn)) for fn in file if fn.endswith(ext) and fn not in excl])
-    return fl
+class MkinvError(Exception):
+    pass
 
 def param_check(param, value_error, index_error, dash_error):
     try:
@@ -81,109 +143,45 @@ def get_arg(param, flag=False, default_value=None, opt_param=False):
     else:
         report('%s parameter not found' % param, out=True)
         
-#if a product LID does not match the collection LID, it's labeled as a secondary product in the inventory
-def mem_check(lid):
-    if lid.startswith(collection_lid):
-        return 'P'
-    else:
-        return 'S'
+#how much of the start of each label the quick scan reads. the Identification_Area is almost always well inside this.
+QUICK_READ = 8192
+LID_PATTERN = re.compile(rb'<logical_identifier>([^<]*)</logical_identifier>')
+VID_PATTERN = re.compile(rb'<version_id>([^<]*)</version_id>')
 
-def report(msg, out=False, integ=False):
-    if (debug and not log_file) or out or integ:
-        print(msg)
-    if log_file:
-        if os.path.isfile(log_file):
-            woa = 'a'
-        else:
-            woa = 'w'
-        with open(log_file, woa) as f:
-            q = f.write(msg+'\n')
+def scan_lidvid(file, ns):
+    '''returns (lid, vid) from the start of a label, or None if the quick scan can't be sure of them'''
+    with open(file, 'rb') as f:
+        head = f.read(QUICK_READ)
+    profile.count('bytes read', len(head))
 
-    if out:
-        print('mkinv exited without finishing.')
-        sys.exit()
+    lid_match = LID_PATTERN.search(head)
+    vid_match = VID_PATTERN.search(head)
+    if lid_match is None or vid_match is None or vid_match.start() < lid_match.start():
+        return None
+
+    #anything that would make the parser see something other than the raw text gets left to the parser:
+    #comments or CDATA around the elements, a default namespace other than (or besides) ns, entities, CRLF line endings
+    prefix = head[:vid_match.end()]
+    if b'<!--' in prefix or b'<![CDATA[' in prefix or prefix.count(b'xmlns="') != 1 or (b'xmlns="%s"' % ns.encode()) not in prefix:
+        return None
+    lid, vid = lid_match.group(1), vid_match.group(1)
+    if b'&' in lid + vid or b'\r' in lid + vid:
+        return None
 
-#reading in command line arguments
-debug, log_file = get_arg('-d', flag=True, opt_param=True)
-ns = 'http://pds.nasa.gov/pds4/pds/v%s' % get_arg('-v', default_value='1')
-lbl_ext = get_arg('-e', default_value='xml')
-inventory_file = get_arg('-f', default_value='inventory.csv')
-collection_lid = get_arg('-l', default_value='urn:nasa:pds:bundle_id:collection_id')
-
-#if help command given, print readme and exit
-if get_arg('-h', flag=True) or get_arg('--help', flag=True):
-    with open('readme.txt') as f:
-        readme = f.read()
-        print()
-        print(readme)
-    sys.exit()
-
-#check to make sure at least one argument is given, which should be the collection path
-if len(args) > 1:
-    collection_fp = args[1]
-    if not os.path.isabs(collection_fp):
-        #if collection path is relative, get current working directory
-        collection_fp = os.path.normpath(os.path.join(os.getcwd(), collection_fp))
-else:
-    report('No path specified.', out=True)
-    
-
-if os.path.isdir(collection_fp):
-    #if the path argument is to a directory, check to see if there happens to be a collection file in the usual place.
-    collection_path = collection_fp
-    test_collection = '%s/collection.%s' % (collection_fp, lbl_ext)
-    collection_filename = os.path.basename(test_collection)
-    
-    report('No collection file specified. Checking for collection LID.')
-    if not get_arg('-l', flag=True):
-        report('No collection LID specified. Checking for %s' % collection_filename)
-        if os.path.isfile(test_collection):
-            #if user did not specify a collection LID, pull one from the collection file.
-            collection_lid = et.parse(test_collection).getroot().find('.//{%s}logical_identifier' % ns).text
-            report('%s pulled from %s' % (collection_lid, collection_filename))
-        else:
-            #if there is no collection file and no specified collection LID, compare LIDs against a dummy LID.
-            report('%s not found. Collection LID not specified. Using %s for collection LID.' % (collection_filename, collection_lid))
-            collection_filename = 'N/A'
-elif os.path.isfile(collection_fp):
-    #if the path argument is to a file, pull the collection LID from that file
-    manual_lid = collection_lid
     try:
-        collection_lid = et.parse(collection_fp).getroot().find('.//{%s}logical_identifier' % ns).text
-    except AttributeError:
-        report('Attribute {%s}logical_identifier not found in %s.' % (ns, collection_fp), out=True)
-    if get_arg('-l', flag=True) and not (manual_lid == collection_lid):
-        #if for some reason the user has pointed to a file and also manually specified a collection lid, use the user-specified one
-        report('Overriding extracted "%s" with explicit "%s"' % (collection_lid, manual_lid))
-        collection_lid = manual_lid
-
-    collection_path = os.path.dirname(collection_fp)
-    collection_filename = os.path.basename(collection_fp)
-else:
-    report('No valid collection file or directory.', out=True)
-
-#if given inventory and log file names are relative, put them in the collection path.
-if not os.path.isabs(inventory_file):
-    inventory_file = os.path.normpath(os.path.join(collection_path, inventory_file))
-
-if log_file and not os.path.isabs(log_file):
-    log_file = os.path.normpath(os.path.join(collection_path, log_file))
-
-report('collection path: %s' % collection_path)
-report('collection lid: %s' % collection_lid)
-report('collection filename: %s' % collection_filename)
-report('inventory file: %s' % inventory_file)
-
-#crawl through the subdirs in the given path and find all files that match the given label extension
-fl = file_list(collection_path, lbl_ext)
-if len(fl) == 0:
-    report('No label files found with extension %s in any subdirectories of %s' % (lbl_ext, collection_path))
-    
-inv_list = []
-
-for file in fl:
-    #go through each file, but ignore the collection file
-    if not os.path.basename(file) == collection_filename:
+        return lid.decode('utf-8'), vid.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+def read_lidvid(file, ns, quick=True):
+    with profile.phase('parse'):
+        profile.count('labels parsed')
+        if quick:
+            lidvid = scan_lidvid(file, ns)
+            if lidvid is not None:
+                return lidvid
+
+        lid = vid = None
         #iteratively parse each label rather than loading the entire thing, and stop once LID and VID have been identified
         for _, elem in et.iterparse(file):
             if elem.tag == '{%s}logical_identifier' % ns:
@@ -192,55 +190,656 @@ for file in fl:
                 vid = elem.text
                 break
         elem.clear()
+        profile.count('labels parsed as XML')
+        if profile.enabled:
+            #the parser reads ahead in blocks, so this is close to what it read however early it stopped
+            profile.count('bytes read', os.path.getsize(file))
+        return lid, vid
 
-        inv_list.append({'mem': mem_check(lid), 'lid': lid, 'vid': vid, 'file': file})
-        report('LIDVID %s::%s found in %s' % (lid, vid, file))
-        
-report('%s product LIDVIDs found' % len(inv_list))
+#labels handed to a worker at a time, and how many of those chunks each worker can have queued ahead of the writer
+CHUNK_SIZE = 64
+QUEUE_DEPTH = 2
 
-#check for extant inventory file if user wants to append
-if get_arg('-a', flag=True):
-    if os.path.isfile(inventory_file):
-        woa = 'a'
-    else:
-        report('No inventory file to append to.', out=True)
-else:
-    woa = 'w'
-
-#integrity check looks for duplicate LIDVIDs from those extracted checks to make sure a product hasn't already been added to the inventory if the user is appending
-if get_arg('-i', flag=True):
-    #create a set of the harvested LIDVIDs to remove duplicates
-    lidvid_list = ['%s::%s' % (i['lid'], i['vid']) for i in inv_list]
-    lidvid_set = set(lidvid_list)
-    new_inv = []
+def read_chunk(files, ns, quick, lidvids):
+    '''returns the LIDVIDs of files, with the times and counts for --profile if read in a worker process'''
+    #lidvids holds any LIDVIDs already known, so only the rest get read
+    return profile.remote(lambda: [lidvid or read_lidvid(file, ns, quick) for file, lidvid in zip(files, lidvids)])
+
+def make_pool(workers, threads):
+    if threads:
+        return ThreadPoolExecutor(max_workers=workers)
+    #forked workers start fastest, but since the tool only runs under main, spawned workers can import it safely too
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+def harvest(entries, ns, workers=1, threads=False, quick=True, lookup=None):
+    '''yields (file, lid, vid) for each label DirEntry in entries, in the same order as entries. lookup(entry) can return an already known (lid, vid) to skip reading a label'''
+    if workers < 2:
+        for entry in entries:
+            lidvid = lookup(entry) if lookup else None
+            yield (entry.path,) + (lidvid or read_lidvid(entry.path, ns, quick))
+        return
+
+    #chunks are submitted as the walk finds files and collected oldest first, so output matches a serial run.
+    #the walk waits once enough chunks are queued, which keeps memory flat however big the collection is.
+    pending = deque()
+    with make_pool(workers, threads) as pool:
+        entries = iter(entries)
+        while True:
+            chunk = list(islice(entries, CHUNK_SIZE))
+            if chunk:
+                lidvids = [lookup(entry) for entry in chunk] if lookup else [None]*len(chunk)
+                chunk = [entry.path for entry in chunk]
+                if all(lidvids):
+                    pending.append((chunk, lidvids))
+                else:
+                    pending.append((chunk, pool.submit(read_chunk, chunk, ns, quick, lidvids)))
+            if pending and (not chunk or len(pending) >= workers*QUEUE_DEPTH):
+                chunk_files, lidvids = pending.popleft()
+                if not isinstance(lidvids, list):
+                    #times and counts from worker processes come back with their LIDVIDs
+                    lidvids, stats = lidvids.result()
+                    profile.merge(stats)
+                for file, lidvid in zip(chunk_files, lidvids):
+                    yield (file,) + tuple(lidvid)
+            elif not chunk:
+                break
+
+def load_cache(cache_file, ns):
+    '''returns {path: (size, mtime, lid, vid)} from cache_file, or an empty dict if there's no usable cache'''
+    con = sqlite3.connect(cache_file)
+    with con:
+        con.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        con.execute('CREATE TABLE IF NOT EXISTS labels (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, lid TEXT, vid TEXT)')
+        cached_ns = con.execute("SELECT value FROM meta WHERE key = 'ns'").fetchone()
+        if cached_ns is None or not cached_ns[0] == ns:
+            #LIDVIDs harvested under a different namespace can't be reused
+            con.execute('DELETE FROM labels')
+            con.execute("INSERT OR REPLACE INTO meta VALUES ('ns', ?)", (ns,))
+        cache = {path: (size, mtime, lid, vid) for path, size, mtime, lid, vid in con.execute('SELECT * FROM labels')}
+    con.close()
+    return cache
 
+def save_cache(cache_file, changed, removed):
+    con = sqlite3.connect(cache_file)
+    with con:
+        con.executemany('DELETE FROM labels WHERE path = ?', [(path,) for path in removed])
+        con.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?)', [(path,) + entry for path, entry in changed.items()])
+    con.close()
+
+def harvest_cached(entries, ns, cache_file, root, workers=1, threads=False, quick=True):
+    '''same as harvest, but reuses LIDVIDs from cache_file for labels whose size and mtime haven't changed'''
+    with profile.phase('cache'):
+        cache = load_cache(cache_file, ns)
+    stats = {}
+    changed = {}
+
+    def lookup(entry):
+        path = os.path.relpath(entry.path, root)
+        #the DirEntry keeps its stat result, so each label is only statted once
+        st = entry.stat()
+        stats[path] = (st.st_size, st.st_mtime_ns)
+        entry = cache.get(path)
+        if entry is not None and entry[:2] == stats[path]:
+            profile.count('cache hits')
+            return entry[2:]
+
+    for file, lid, vid in harvest(entries, ns, workers, threads, quick, lookup):
+        path = os.path.relpath(file, root)
+        if not cache.get(path, ())[:2] == stats[path]:
+            changed[path] = stats[path] + (lid, vid)
+        yield file, lid, vid
+
+    report('%s labels unchanged since last run, %s parsed' % (len(stats)-len(changed), len(changed)))
+    with profile.phase('cache'):
+        save_cache(cache_file, changed, set(cache) - set(stats))
+
+def write_run(rows, tmp_dir):
+    with tempfile.NamedTemporaryFile('w', newline='', dir=tmp_dir, delete=False) as f:
+        cw = csv.writer(f)
+        cw.writerows(rows)
+    return f.name
+
+#read buffer for each run being merged, which is what a merge costs per run on top of the rows themselves
+RUN_BUFFER = 64*1024
+#most runs merged at once, so a small budget on a big inventory can't run out of file handles
+MAX_FAN_IN = 64
+
+def read_run(run_file):
+    with open(run_file, newline='', buffering=RUN_BUFFER) as f:
+        for lv, n, file in csv.reader(f):
+            yield lv, int(n), file
+
+def merge_runs(runs, budget, tmp_dir):
+    '''returns an iterator over the sorted rows of all the run files in runs. if there are more runs than the budget
+    has read buffers for, they're merged in passes of that many back onto disk until the rest can be merged at once'''
+    fan_in = max(2, min(MAX_FAN_IN, int(budget // RUN_BUFFER)))
+    while len(runs) > fan_in:
+        merged = []
+        for i in range(0, len(runs), fan_in):
+            group = runs[i:i+fan_in]
+            merged.append(write_run(heapq.merge(*[read_run(r) for r in group]), tmp_dir) if len(group) > 1 else group[0])
+            if len(group) > 1:
+                for r in group:
+                    os.remove(r)
+        runs = merged
+    return heapq.merge(*[read_run(r) for r in runs])
+
+def external_sort(rows, budget, tmp_dir):
+    '''sorts (lidvid, index, file) rows in runs of about budget bytes on disk and returns an iterator that merges them back together, and the number of rows'''
+    runs = []
+    chunk = []
+    chunk_size = 0
+    row_count = 0
+    for row in rows:
+        row_count += 1
+        chunk.append(row)
+        #rough per-row cost of the strings plus the tuple holding them
+        chunk_size += len(row[0]) + len(row[2]) + 200
+        if chunk_size >= budget:
+            runs.append(write_run(sorted(chunk), tmp_dir))
+            chunk = []
+            chunk_size = 0
+
+    if not runs:
+        #everything fit in the budget, so there's no need to touch the disk
+        return iter(sorted(chunk)), row_count
+    if chunk:
+        runs.append(write_run(sorted(chunk), tmp_dir))
+    return merge_runs(runs, budget, tmp_dir), row_count
+
+def vid_key(vid):
+    '''sorts VIDs by version number, so 1.10 comes after 1.9'''
+    try:
+        return (0, tuple([int(part) for part in vid.split('.')]))
+    except ValueError:
+        #not a PDS4 VID, so the best that can be done is to sort it as text after the ones that are
+        return (1, vid)
+
+def merge_inventory(new_lvs, inventory_file, woa, diff_file, budget, tmp_dir, collection_lid):
+    '''integrity checks sorted harvest rows against inventory_file with sorted runs instead of in-memory sets, writes new LIDVIDs and a diff report, and returns the number of LIDVIDs added'''
+    added = 0
     if woa == 'a':
-        #get LIDVIDs from the inventory file if appending
         with open(inventory_file, 'r', newline='') as f:
-            csv_list = [lv for mem, lv in csv.reader(f, delimiter=',')]
-            
-    for lv in sorted(lidvid_set):
+            old_lvs, _ = external_sort(((lv, n, '') for n, (mem, lv) in enumerate(csv.reader(f, delimiter=','))), budget/2, tmp_dir)
+    else:
+        old_lvs = iter([])
+
+    #tag each row with where it came from, so rows for the same LIDVID sort the inventory's first.
+    #a LID can't contain '::', so every LIDVID for a LID ends up next to the others once sorted.
+    merged = heapq.merge(((lv, 0, n, file) for lv, n, file in old_lvs), ((lv, 1, n, file) for lv, n, file in new_lvs))
+
+    with open(inventory_file, woa, newline='') as f, open(diff_file, 'w', newline='') as df:
+        cw = csv.writer(f)
+        dw = csv.writer(df)
+        for lid, lid_rows in groupby(merged, key=lambda row: row[0].split('::')[0]):
+            #only the rows for one LID are held at a time
+            lid_rows = list(lid_rows)
+            old_vids = sorted({row[0].split('::')[-1] for row in lid_rows if not row[1]}, key=vid_key)
+            for lv, lv_rows in groupby(lid_rows, key=lambda row: row[0]):
+                lv_rows = list(lv_rows)
+                files = [file for _, new, _, file in lv_rows if new]
+                if not files:
+                    continue
+
+                #check for multiple instances of each LIDVID
+                if len(files) > 1:
+                    report('%s products with LIDVID %s found' % (len(files), lv), integ=True)
+                    for file in files:
+                        report('product: %s' % file, integ=True)
+
+                mem = mem_check(lv, collection_lid)
+                if mem == 'S':
+                    report('Product LID %s does not match collection LID %s' % (lv, collection_lid))
+
+                if not lv_rows[0][1]:
+                    report('LIDVID %s already in %s' % (lv, os.path.basename(inventory_file)), integ=True)
+                    q = dw.writerow(['present', lv, ''])
+                else:
+                    q = cw.writerow([mem, lv])
+                    added += 1
+                    if old_vids and vid_key(lv.split('::')[-1]) > vid_key(old_vids[-1]):
+                        q = dw.writerow(['bumped', lv, ';'.join(old_vids)])
+                    elif old_vids:
+                        #a version older than the latest one already in the inventory
+                        q = dw.writerow(['older', lv, ';'.join(old_vids)])
+                    else:
+                        q = dw.writerow(['added', lv, ''])
+    return added
+
+def found_lidvids(lidvids):
+    for file, lid, vid in lidvids:
+        report('LIDVID %s::%s found in %s' % (lid, vid, file), level=DEBUG)
+        yield file, lid, vid
+
+def report_found(found, lbl_ext, collection_path):
+    if found == 0:
+        report('No label files found with extension %s in any subdirectories of %s' % (lbl_ext, collection_path))
+    report('%s product LIDVIDs found' % found)
+
+#if a product LID does not match the collection LID, it's labeled as a secondary product in the inventory
+def mem_check(lid, collection_lid):
+    if lid.startswith(collection_lid):
+        return 'P'
+    else:
+        return 'S'
+
+def report(msg, out=False, integ=False, level=INFO):
+    #integrity problems are always shown, and anything that stops the tool is an error
+    log(msg, ERROR if out else WARNING if integ else level)
+
+    if out:
+        print('mkinv exited without finishing.')
+        sys.exit()
+
+def find_collection(path, lbl_ext='xml', ns=NS % 1, collection_lid=None):
+    '''returns (collection directory, collection file name, collection LID) for a path to a collection directory or file.
+    collection_lid overrides the LID in the collection file. raises MkinvError if path isn't either'''
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        #if the path argument is to a directory, check to see if there happens to be a collection file in the usual place.
+        test_collection = '%s/collection.%s' % (path, lbl_ext)
+        collection_filename = os.path.basename(test_collection)
+
+        report('No collection file specified. Checking for collection LID.')
+        if collection_lid is None:
+            report('No collection LID specified. Checking for %s' % collection_filename)
+            if os.path.isfile(test_collection):
+                #if user did not specify a collection LID, pull one from the collection file.
+                collection_lid = et.parse(test_collection).getroot().find('.//{%s}logical_identifier' % ns).text
+                report('%s pulled from %s' % (collection_lid, collection_filename))
+            else:
+                #if there is no collection file and no specified collection LID, compare LIDs against a dummy LID.
+                collection_lid = DEFAULT_LID
+                report('%s not found. Collection LID not specified. Using %s for collection LID.' % (collection_filename, collection_lid))
+                collection_filename = 'N/A'
+        return path, collection_filename, collection_lid
+    elif os.path.isfile(path):
+        #if the path argument is to a file, pull the collection LID from that file
+        try:
+            file_lid = et.parse(path).getroot().find('.//{%s}logical_identifier' % ns).text
+        except AttributeError:
+            raise MkinvError('Attribute {%s}logical_identifier not found in %s.' % (ns, path))
+        if collection_lid is not None and not (collection_lid == file_lid):
+            #if for some reason the user has pointed to a file and also manually specified a collection lid, use the user-specified one
+            report('Overriding extracted "%s" with explicit "%s"' % (file_lid, collection_lid))
+        return os.path.dirname(path), os.path.basename(path), collection_lid or file_lid
+    else:
+        raise MkinvError('No valid collection file or directory.')
+
+def complete_lidvids(lidvids, ns):
+    '''passes on (file, lid, vid) for each label with both a LID and a VID, reporting the rest so they never make it into an inventory'''
+    for file, lid, vid in lidvids:
+        if lid is None or vid is None:
+            missing = ' or '.join([tag for tag, value in [('logical_identifier', lid), ('version_id', vid)] if value is None])
+            report('No {%s}%s found in %s. Label left out of the inventory.' % (ns, missing, file), integ=True)
+        else:
+            yield file, lid, vid
+
+def find_lidvids(path, lbl_ext='xml', ns=NS % 1, workers=1, threads=False, quick=True, walkers=1, cache_file=None, skip=None):
+    '''returns an iterator of (file, lid, vid) for each label under path, leaving out the file named skip, read as it's needed.
+    labels are read as the walk finds them and each LIDVID is passed on as soon as it's read, so nothing here holds the whole collection.'''
+    entries = (entry for entry in profile.iterate('walk', scan(path, lbl_ext, workers=walkers), 'files scanned') if not entry.name == skip)
+
+    if cache_file:
+        lidvids = harvest_cached(entries, ns, cache_file, path, workers, threads, quick)
+    else:
+        lidvids = harvest(entries, ns, workers, threads, quick)
+    #whatever harvesting does besides walking and parsing, like waiting on workers, is charged to harvest
+    return profile.iterate('harvest', complete_lidvids(lidvids, ns))
+
+def harvest_lidvids(path, lbl_ext='xml', version=1, workers=1, threads=False, quick=True, walkers=1, cache_file=None):
+    '''returns a list of (file, lid, vid) for every label in the collection at path, a collection directory or file,
+    leaving out the collection file itself'''
+    ns = NS % version
+    collection_path, collection_filename, collection_lid = find_collection(path, lbl_ext, ns)
+    return list(find_lidvids(collection_path, lbl_ext, ns, workers, threads, quick, walkers, cache_file, collection_filename))
+
+def group_lidvids(lidvids):
+    '''returns {LIDVID: [files with it]} for (file, lid, vid) rows, and the number of rows'''
+    #group the harvested files by LIDVID as they come in, which also removes duplicates
+    lidvid_files = defaultdict(list)
+    found = 0
+    for file, lid, vid in lidvids:
+        found += 1
+        lidvid_files['%s::%s' % (lid, vid)].append(file)
+    return lidvid_files, found
+
+def check_inventory(lidvid_files, collection_lid, existing=(), inventory_name='inventory'):
+    '''integrity checks grouped LIDVIDs and returns sorted inventory rows [member status, LIDVID], with no duplicates and none of the LIDVIDs in existing'''
+    new_inv = []
+    for lv in sorted(lidvid_files):
         #check for multiple instances of each LIDVID
-        lv_count = lidvid_list.count(lv)
+        lv_count = len(lidvid_files[lv])
         if lv_count > 1:
             report('%s products with LIDVID %s found' % (lv_count, lv), integ=True)
-            for i in inv_list:
-                if '%s::%s' % (i['lid'], i['vid']) == lv:
-                    report('product: %s' % i['file'], integ=True)
+            for file in lidvid_files[lv]:
+                report('product: %s' % file, integ=True)
 
-        if mem_check(lv) == 'S':
+        mem = mem_check(lv, collection_lid)
+        if mem == 'S':
             report('Product LID %s does not match collection LID %s' % (lv, collection_lid))
 
-        if woa == 'a' and lv in csv_list:
-            report('LIDVID %s already in %s' % (lv, os.path.basename(inventory_file)), integ=True)
+        if lv in existing:
+            report('LIDVID %s already in %s' % (lv, inventory_name), integ=True)
         else:
             #create a new LIDVID list with no duplicates and no already present LIDVIDs
-            new_inv.append({'mem': mem_check(lv), 'lid': lv.split('::')[0], 'vid': lv.split('::')[-1]})
+            new_inv.append([mem, lv])
+    return new_inv
+
+def make_inventory(path, collection_lid=None, lbl_ext='xml', version=1, existing=(), workers=1, threads=False, quick=True, walkers=1, cache_file=None):
+    '''integrity checks the collection at path like -i and returns (collection LID, inventory rows [member status, LIDVID]
+    leaving out any LIDVIDs in existing, {LIDVID: [files]} for each LIDVID found in more than one label)'''
+    ns = NS % version
+    collection_path, collection_filename, collection_lid = find_collection(path, lbl_ext, ns, collection_lid)
+    lidvid_files, found = group_lidvids(find_lidvids(collection_path, lbl_ext, ns, workers, threads, quick, walkers, cache_file, collection_filename))
+    duplicates = {lv: files for lv, files in lidvid_files.items() if len(files) > 1}
+    return collection_lid, check_inventory(lidvid_files, collection_lid, existing), duplicates
+
+def read_collection_lid(collection_file, ns):
+    try:
+        return et.parse(collection_file).getroot().find('.//{%s}logical_identifier' % ns).text
+    except (AttributeError, et.ParseError):
+        report('No {%s}logical_identifier found in %s. Using %s for collection LID.' % (ns, collection_file, DEFAULT_LID), integ=True)
+        return DEFAULT_LID
+
+def route_labels(entries, root, ns, collections, owners, outside):
+    '''yields the label DirEntries in entries that belong to a collection, leaving out the collection files themselves.
+    collection files found along the way are added to collections as {directory: (file name, LID)}, the collection
+    directory each label directory belongs to goes in owners, and labels outside any collection go in outside'''
+    owners[root] = None
+    #the walk lists all of a directory's files before any of its subdirectories, so a directory's collection file is
+    #always found before the labels under it, even if it comes after some of the labels beside it
+    for directory, dir_entries in groupby(entries, key=lambda entry: os.path.dirname(entry.path)):
+        dir_entries = list(dir_entries)
+        collection_files = sorted([entry.name for entry in dir_entries if entry.name.startswith('collection')])
+        if collection_files:
+            if len(collection_files) > 1:
+                report('%s collection files found in %s. Using %s.' % (len(collection_files), directory, collection_files[0]), integ=True)
+            collections[directory] = (collection_files[0], read_collection_lid(os.path.join(directory, collection_files[0]), ns))
+            report('collection %s found in %s' % (collections[directory][1], directory))
+            owners[directory] = directory
+        else:
+            #labels belong to the nearest collection above them
+            parent = directory
+            chain = []
+            while parent not in owners:
+                chain.append(parent)
+                parent = os.path.dirname(parent)
+            for d in chain:
+                owners[d] = owners[parent]
+
+        for entry in dir_entries:
+            if entry.name.startswith('collection') and directory in collections:
+                continue
+            elif owners[directory] is None:
+                outside.append(entry.path)
+            else:
+                yield entry
+
+def find_bundle_lidvids(path, collections, outside, lbl_ext='xml', ns=NS % 1, workers=1, threads=False, quick=True, walkers=1, cache_file=None):
+    '''returns an iterator of (collection directory, file, lid, vid) for each label in every collection under the bundle at path,
+    from a single walk with one pool of workers for the whole bundle. collections and outside are filled in as for route_labels.'''
+    path = os.path.abspath(path)
+    owners = {}
+    entries = route_labels(profile.iterate('walk', scan(path, lbl_ext, workers=walkers), 'files scanned'), path, ns, collections, owners, outside)
+
+    if cache_file:
+        lidvids = harvest_cached(entries, ns, cache_file, path, workers, threads, quick)
+    else:
+        lidvids = harvest(entries, ns, workers, threads, quick)
+    #each label's directory was routed to its collection before the label could be read
+    return ((owners[os.path.dirname(file)], file, lid, vid) for file, lid, vid in profile.iterate('harvest', complete_lidvids(lidvids, ns)))
+
+def harvest_bundle(path, lbl_ext='xml', version=1, workers=1, threads=False, quick=True, walkers=1, cache_file=None):
+    '''returns ({collection directory: (collection LID, [(file, lid, vid)])} for every collection under the bundle at path,
+    {LIDVID: [collection directories]} for each LIDVID found in more than one collection)'''
+    collections = {}
+    harvested = defaultdict(list)
+    for collection, file, lid, vid in find_bundle_lidvids(path, collections, [], lbl_ext, NS % version, workers, threads, quick, walkers, cache_file):
+        harvested[collection].append((file, lid, vid))
+
+    lidvid_collections = defaultdict(list)
+    for collection, lidvids in harvested.items():
+        for lv in {'%s::%s' % (lid, vid) for file, lid, vid in lidvids}:
+            lidvid_collections[lv].append(collection)
+    return ({collection: (lid, harvested[collection]) for collection, (name, lid) in collections.items()},
+            {lv: sorted(found_in) for lv, found_in in lidvid_collections.items() if len(found_in) > 1})
+
+def bundle_inventory(path, inventory_name, lbl_ext='xml', ns=NS % 1, append=False, integrity=False, workers=1, threads=False, quick=True, walkers=1, cache_file=None):
+    '''writes an inventory named inventory_name in every collection under the bundle at path from a single walk, reporting
+    any LIDVID found in more than one collection, and returns {collection directory: number of LIDVIDs written}'''
+    collections = {}
+    outside = []
+    lidvids = find_bundle_lidvids(path, collections, outside, lbl_ext, ns, workers, threads, quick, walkers, cache_file)
+    #the collection each LIDVID was first found in, and every collection for those found in more than one
+    debug = log.enabled(DEBUG)
+    first_found = {}
+    cross = defaultdict(set)
+    grouped = defaultdict(lambda: defaultdict(list))
+    found = Counter()
+    written = Counter()
+    writers = {}
+
+    def inventory_file(collection):
+        return os.path.join(collection, inventory_name)
+
+    def open_mode(collection):
+        if not append:
+            return 'w'
+        elif os.path.isfile(inventory_file(collection)):
+            return 'a'
+        report('No inventory file to append to in %s. Writing a new one.' % collection)
+        return 'w'
+
+    with ExitStack() as stack:
+        for collection, file, lid, vid in lidvids:
+            lv = '%s::%s' % (lid, vid)
+            if debug:
+                report('LIDVID %s found in %s' % (lv, file), level=DEBUG)
+            found[collection] += 1
+            if first_found.setdefault(lv, collection) != collection:
+                cross[lv].update([first_found[lv], collection])
+
+            if integrity:
+                grouped[collection][lv].append(file)
+            else:
+                #without integrity checking each LIDVID can be written out as soon as it's found
+                if collection not in writers:
+                    writers[collection] = csv.writer(stack.enter_context(open(inventory_file(collection), open_mode(collection), newline='')))
+                q = writers[collection].writerow([mem_check(lid, collections[collection][1]), lv])
+                written[collection] += 1
+
+    report('%s collections found' % len(collections))
+    if outside:
+        report('%s labels found outside any collection' % len(outside))
+        for file in outside:
+            report('outside: %s' % file, level=DEBUG)
+
+    for collection in sorted(collections):
+        name, collection_lid = collections[collection]
+        report('%s product LIDVIDs found in %s' % (found[collection], collection_lid))
+        if integrity:
+            mode = open_mode(collection)
+            if mode == 'a':
+                with open(inventory_file(collection), 'r', newline='') as f:
+                    csv_set = {lv for mem, lv in csv.reader(f, delimiter=',')}
+            else:
+                csv_set = set()
+            new_inv = check_inventory(grouped.pop(collection, {}), collection_lid, csv_set, inventory_name)
+            with open(inventory_file(collection), mode, newline='') as f:
+                cw = csv.writer(f)
+                cw.writerows(new_inv)
+            written[collection] = len(new_inv)
+        elif collection not in writers and not append:
+            #collections with no labels still get an (empty) inventory, like a single collection would
+            q = open(inventory_file(collection), 'w').close()
+        report('%s product LIDVIDs added to %s' % (written[collection], inventory_file(collection)))
+
+    #the same LIDVID in two collections means one of them has a product that belongs to the other, or a stale copy
+    for lv in sorted(cross):
+        report('LIDVID %s found in %s collections' % (lv, len(cross[lv])), integ=True)
+        for collection in sorted(cross[lv]):
+            report('collection: %s (%s)' % (collections[collection][1], collection), integ=True)
+    return {collection: written[collection] for collection in sorted(collections)}
+
+def main():
+    global log, profile
+
+    #reading in command line arguments
+    debug, log_file = get_arg('-d', flag=True, opt_param=True)
+    log = Log('mkinv', debug, log_file)
+    profiling, profile_file = get_arg('--profile', flag=True, opt_param=True)
+    _, cprofile_file = get_arg('--cprofile', flag=True, opt_param=True)
+    profile = Profile('mkinv', profiling)
+    ns = NS % get_arg('-v', default_value='1')
+    lbl_ext = get_arg('-e', default_value='xml')
+    inventory_file = get_arg('-f', default_value='inventory.csv')
+    manual_lid = get_arg('-l', default_value=DEFAULT_LID) if get_arg('-l', flag=True) else None
+    workers = get_arg('-j', default_value='1')
+    threads = get_arg('-t', flag=True)
+    quick = not get_arg('-x', flag=True)
+    walkers = get_arg('-w', default_value='1')
+    use_cache, cache_file = get_arg('-c', flag=True, opt_param=True)
+    merge_budget = get_arg('-m', default_value='0')
+
+    try:
+        workers = int(workers)
+    except ValueError:
+        report('invalid -j parameter', out=True)
+
+    try:
+        walkers = int(walkers)
+    except ValueError:
+        report('invalid -w parameter', out=True)
+
+    try:
+        merge_budget = float(merge_budget)*1024**2
+    except ValueError:
+        report('invalid -m parameter', out=True)
+
+    #if help command given, print readme and exit
+    if get_arg('-h', flag=True) or get_arg('--help', flag=True):
+        with open('readme.txt') as f:
+            readme = f.read()
+            print()
+            print(readme)
+        sys.exit()
+
+    #check to make sure at least one argument is given, which should be the collection path
+    if len(args) > 1:
+        collection_fp = args[1]
+        if not os.path.isabs(collection_fp):
+            #if collection path is relative, get current working directory
+            collection_fp = os.path.normpath(os.path.join(os.getcwd(), collection_fp))
+    else:
+        report('No path specified.', out=True)
+
+    bundle = get_arg('-b', flag=True)
+    if bundle:
+        #in bundle mode the collections come from the walk, and the inventory file name is used in each of them
+        if not os.path.isdir(collection_fp):
+            report('-b needs the path to the bundle directory.', out=True)
+        if os.path.isabs(inventory_file) or not os.path.basename(inventory_file) == inventory_file:
+            report('-f must be a file name with -b, so it can go in each collection directory.', out=True)
+        if manual_lid is not None:
+            report('-l ignored with -b. Each collection LID comes from its collection file.')
+        if merge_budget:
+            report('-m ignored with -b. The integrity check is done in memory.')
+        collection_path = collection_fp
+    else:
+        try:
+            collection_path, collection_filename, collection_lid = find_collection(collection_fp, lbl_ext, ns, manual_lid)
+        except MkinvError as e:
+            report(str(e), out=True)
+
+    #if given inventory and log file names are relative, put them in the collection path.
+    if not os.path.isabs(inventory_file) and not bundle:
+        inventory_file = os.path.normpath(os.path.join(collection_path, inventory_file))
+
+    if log_file and not os.path.isabs(log_file):
+        log.log_file = os.path.normpath(os.path.join(collection_path, log_file))
+
+    if profile_file and not os.path.isabs(profile_file):
+        profile_file = os.path.normpath(os.path.join(collection_path, profile_file))
+
+    if cprofile_file and not os.path.isabs(cprofile_file):
+        cprofile_file = os.path.normpath(os.path.join(collection_path, cprofile_file))
+
+    if use_cache:
+        cache_file = os.path.normpath(os.path.join(collection_path, cache_file or '.mkinv_cache.db'))
+
+    if bundle:
+        report('bundle path: %s' % collection_path)
+        #one walk and one pool of workers for every collection in the bundle
+        with profile.phase('inventory'), profile.cprofile(cprofile_file):
+            bundle_inventory(collection_path, inventory_file, lbl_ext, ns, get_arg('-a', flag=True), get_arg('-i', flag=True),
+                             workers, threads, quick, walkers, cache_file if use_cache else None)
+        if profiling:
+            profile.report(profile_file)
+        return
+
+    report('collection path: %s' % collection_path)
+    report('collection lid: %s' % collection_lid)
+    report('collection filename: %s' % collection_filename)
+    report('inventory file: %s' % inventory_file)
+
+    #check for extant inventory file if user wants to append
+    if get_arg('-a', flag=True):
+        if os.path.isfile(inventory_file):
+            woa = 'a'
+        else:
+            report('No inventory file to append to.', out=True)
+    else:
+        woa = 'w'
+
+    #crawl through the subdirs in the given path and find all files that match the given label extension, ignoring the collection file.
+    lidvids = find_lidvids(collection_path, lbl_ext, ns, workers, threads, quick, walkers, cache_file if use_cache else None, collection_filename)
+
+    if log.enabled(DEBUG):
+        #with debug off, LIDVIDs go straight through without a message being built for each
+        lidvids = found_lidvids(lidvids)
+    found = 0
+
+    #everything from here on pulls the LIDVIDs through the walk and harvest, so it's the hot loop for --cprofile
+    with profile.phase('inventory'), profile.cprofile(cprofile_file):
+        #integrity check looks for duplicate LIDVIDs from those extracted checks to make sure a product hasn't already been added to the inventory if the user is appending
+        if get_arg('-i', flag=True) and merge_budget:
+            #same check as below, but streamed through sorted runs so memory stays within the budget
+            diff_file = '%s_diff.csv' % os.path.splitext(inventory_file)[0]
+            with tempfile.TemporaryDirectory(prefix='mkinv_') as tmp_dir:
+                new_lvs, found = external_sort((('%s::%s' % (lid, vid), n, file) for n, (file, lid, vid) in enumerate(lidvids)), merge_budget/2, tmp_dir)
+                report_found(found, lbl_ext, collection_path)
+                report('%s product LIDVIDs added' % merge_inventory(new_lvs, inventory_file, woa, diff_file, merge_budget, tmp_dir, collection_lid))
+            report('diff report: %s' % diff_file)
+        elif get_arg('-i', flag=True):
+            lidvid_files, found = group_lidvids(lidvids)
+            report_found(found, lbl_ext, collection_path)
+
+            if woa == 'a':
+                #get LIDVIDs from the inventory file if appending
+                with open(inventory_file, 'r', newline='') as f:
+                    csv_set = {lv for mem, lv in csv.reader(f, delimiter=',')}
+            else:
+                csv_set = set()
+
+            new_inv = check_inventory(lidvid_files, collection_lid, csv_set, os.path.basename(inventory_file))
+            report('%s product LIDVIDs added' % len(new_inv))
+
+            with open(inventory_file, woa, newline='') as f:
+                cw = csv.writer(f)
+                cw.writerows(new_inv)
+        else:
+            #without integrity checking each LIDVID can be written out as soon as it's found
+            with open(inventory_file, woa, newline='') as f:
+                cw = csv.writer(f)
+                for file, lid, vid in lidvids:
+                    found += 1
+                    q = cw.writerow([mem_check(lid, collection_lid), '%s::%s' % (lid, vid)])
+            report_found(found, lbl_ext, collection_path)
 
-    inv_list = new_inv
-    report('%s product LIDVIDs added' % len(inv_list))
+    if profiling:
+        profile.report(profile_file)
 
-with open(inventory_file, woa, newline='') as f:
-    cw = csv.writer(f)
-    for i in inv_list:
-        q = cw.writerow([i['mem'], '%s::%s' % (i['lid'], i['vid'])])
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,77 @@
 import os
 import re
+import json
+import time
+import atexit
+import threading
+import cProfile
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 #functions i need to reuse across different scripts that aren't directly related to PDS4
 
-def flist(path, ext='', excl=[]):
-    '''returns all files in path that end with ext and are not in list excl'''
-    fl = []
-    for root, _, file in os.walk(path):
-        fl.extend([os.path.normpath(os.path.join(root, fn)) for fn in file if fn.endswith(ext) and all([re.search(e, fn) is None for e in excl])])
-    return fl
+def list_dir(path, matcher=None):
+    '''returns the (files, subdirs) DirEntries in path, leaving out any whose name matches matcher'''
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if matcher is not None and matcher.search(entry.name):
+                    continue
+                #is_dir comes from the directory listing itself on most filesystems, so this doesn't stat every file.
+                #like os.walk, symlinks to directories are neither files nor descended into.
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry)
+                else:
+                    files.append(entry)
+    except OSError:
+        #like os.walk, skip directories that can't be read
+        pass
+    return files, dirs
+
+def scan(path, ext='', excl=[], workers=1):
+    '''yields a DirEntry for every file under path that ends with ext, in the same order as os.walk.
+    files and directories whose names match any regex in excl are skipped, so excluded directories are never descended into.
+    with workers > 1, the next few directories in walk order are listed concurrently, which helps on high-latency filesystems.'''
+    matcher = re.compile('|'.join(['(?:%s)' % e for e in excl])) if excl else None
+    top = os.path.normpath(path)
+
+    if workers < 2:
+        stack = [top]
+        while stack:
+            files, dirs = list_dir(stack.pop(), matcher)
+            for entry in files:
+                if entry.name.endswith(ext):
+                    yield entry
+            stack.extend(reversed([d.path for d in dirs]))
+        return
+
+    #the next directories in walk order are listed ahead of time, but only a window of them at once, so a wide tree
+    #doesn't get listed faster than it's read. each item in stack is [path, future or None if not requested yet]
+    window = workers*2
+    pending = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stack = [[top, None]]
+        while stack:
+            for item in reversed(stack):
+                if pending >= window:
+                    break
+                if item[1] is None:
+                    item[1] = pool.submit(list_dir, item[0], matcher)
+                    pending += 1
+            path, future = stack.pop()
+            pending -= 1
+            files, dirs = future.result()
+            for entry in files:
+                if entry.name.endswith(ext):
+                    yield entry
+            stack.extend(reversed([[d.path, None] for d in dirs]))
+
+def flist(path, ext='', excl=[], workers=1):
+    '''returns all files in path that end with ext and don't match any regex in excl'''
+    return [entry.path for entry in scan(path, ext, excl, workers)]
 
 def make80(input_string, line_limit=80):
     '''returns a list of lines no longer than 80 characters'''
@@ -23,3 +86,193 @@ def make80(input_string, line_limit=80):
                 lines.append(word.strip())
         lines.append('')
     return lines
+
+#log levels, lowest to highest
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+
+class Log:
+    '''debugging output for a tool. warnings and errors always go to the console. with debug, everything else does too,
+    unless there's a log file, in which case every message goes to the file instead, as plain lines or, for a .jsonl
+    file, as JSON records. the file is opened once and written in batches, and with debug off messages below warning
+    are dropped before anything is done with them. a quiet log prints nothing, for when a tool is used as a library.'''
+    def __init__(self, tool, debug=False, log_file=None, buffer_lines=1000, quiet=False):
+        self.tool = tool
+        #log_file can still be changed until the first batch is written
+        self.log_file = log_file
+        self.console_level = ERROR+1 if quiet else DEBUG if debug and not log_file else WARNING
+        self.file_level = DEBUG if log_file else ERROR+1
+        self.level = min(self.console_level, self.file_level)
+        self.buffer_lines = buffer_lines
+        self.buffer = []
+        self.handle = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def enabled(self, level=DEBUG):
+        '''whether a message at level would go anywhere, for skipping the work of building messages that wouldn't'''
+        return level >= self.level
+
+    def __call__(self, msg, level=INFO):
+        if level < self.level:
+            return
+        if level >= self.console_level:
+            print(msg)
+        if level >= self.file_level:
+            if not os.getpid() == self.pid:
+                #a forked worker leaves the tool's unwritten lines to the tool, and since workers exit without running
+                #atexit, writes every message through its own handle straight away
+                self.pid, self.handle, self.buffer, self.buffer_lines = os.getpid(), None, [], 1
+                self.lock = threading.Lock()
+            if self.log_file.endswith('.jsonl'):
+                msg = json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tool': self.tool, 'level': LEVEL_NAMES[level], 'msg': msg})
+            with self.lock:
+                self.buffer.append(msg + '\n')
+                if len(self.buffer) >= self.buffer_lines:
+                    self.write()
+
+    def write(self):
+        if not self.buffer:
+            return
+        if self.handle is None:
+            self.handle = open(self.log_file, 'a')
+        self.handle.writelines(self.buffer)
+        #nothing is left in the handle's own buffer for a forked worker to write out again
+        self.handle.flush()
+        self.buffer = []
+
+    def close(self):
+        with self.lock:
+            self.write()
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+class Profile:
+    '''wall and CPU time per phase of a tool, and counters of the work it did, for --profile. time is charged to
+    whichever phase is innermost, so phases of a streamed pipeline that run inside each other each get only their own
+    time. when not enabled, phases, iterate, and count do nothing.'''
+    def __init__(self, tool, enabled=False):
+        self.tool = tool
+        self.enabled = enabled
+        #{phase: [wall seconds, cpu seconds]}
+        self.times = {}
+        self.counts = Counter()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        #each thread keeps its own stack of phases, and cpu time is per thread, so worker threads don't mix up their phases
+        self.local = threading.local()
+        children = os.times()
+        self.start = time.perf_counter(), time.process_time(), children.children_user + children.children_system
+
+    def charge(self):
+        now = time.perf_counter(), time.thread_time()
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            with self.lock:
+                times = self.times.setdefault(stack[-1], [0.0, 0.0])
+                times[0] += now[0] - self.local.mark[0]
+                times[1] += now[1] - self.local.mark[1]
+        else:
+            self.local.stack = []
+        self.local.mark = now
+
+    @contextmanager
+    def timed(self, name):
+        self.charge()
+        self.local.stack.append(name)
+        try:
+            yield
+        finally:
+            self.charge()
+            self.local.stack.pop()
+
+    def phase(self, name):
+        '''context manager that charges the time spent inside it to name'''
+        return self.timed(name) if self.enabled else nullcontext()
+
+    def iterate(self, name, iterable, counter=None):
+        '''charges the time spent getting each item of iterable to name, and counts the items under counter'''
+        if not self.enabled:
+            return iterable
+        return self.timed_iter(name, iter(iterable), counter)
+
+    def timed_iter(self, name, it, counter):
+        while True:
+            with self.timed(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            if counter:
+                self.count(counter)
+            yield item
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counts[name] += n
+
+    def remote(self, fn, *args):
+        '''runs fn(*args) and returns (its result, the times and counts it added in a worker process, for merge)'''
+        if not self.enabled or os.getpid() == self.pid:
+            return fn(*args), None
+        #a forked worker starts each call from nothing, so only what fn adds gets handed back
+        self.times, self.counts, self.local = {}, Counter(), threading.local()
+        return fn(*args), (self.times, self.counts)
+
+    def merge(self, stats):
+        if stats is None:
+            return
+        times, counts = stats
+        with self.lock:
+            for name, (wall, cpu) in times.items():
+                total = self.times.setdefault(name, [0.0, 0.0])
+                total[0] += wall
+                total[1] += cpu
+            self.counts.update(counts)
+
+    @contextmanager
+    def cprofile(self, dump_file):
+        '''runs the block under cProfile and dumps the stats to dump_file, for reading with pstats or snakeviz'''
+        if dump_file is None:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(dump_file)
+
+    def summary(self):
+        '''returns the times and counts as a dict'''
+        #forked workers only show up in the children's cpu time once they've exited
+        children = os.times()
+        return {'tool': self.tool,
+                'total': {'wall': time.perf_counter() - self.start[0], 'cpu': time.process_time() - self.start[1],
+                          'worker cpu': children.children_user + children.children_system - self.start[2]},
+                'phases': {name: {'wall': wall, 'cpu': cpu} for name, (wall, cpu) in self.times.items()},
+                'counts': dict(self.counts)}
+
+    def report(self, report_file=None):
+        '''prints a table of the times and counts, or writes them to report_file as JSON'''
+        summary = self.summary()
+        if report_file:
+            with open(report_file, 'w') as f:
+                json.dump(summary, f, indent=1)
+            return
+
+        print()
+        print('%-24s %10s %10s' % ('phase', 'wall (s)', 'cpu (s)'))
+        for name, times in summary['phases'].items():
+            print('%-24s %10.3f %10.3f' % (name, times['wall'], times['cpu']))
+        print('%-24s %10.3f %10.3f' % ('total', summary['total']['wall'], summary['total']['cpu']))
+        if summary['total']['worker cpu']:
+            print('%-24s %10s %10.3f' % ('worker processes', '', summary['total']['worker cpu']))
+        if summary['counts']:
+            print()
+            for name, n in summary['counts'].items():
+                print('%-24s %10s' % (name, n))